@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Floods a channel with 1000 lines per second and measures how late the main
+# loop gets around to a timeout that should fire every 10ms, which is about
+# what a key press has to wait for as well. Needs a display.
+# Run with: python -m benchmarks.flood
+import os
+import os.path
+import statistics
+import time
+
+from src import versions  # noqa nosort
+from gi.repository import GLib  # noqa nosort
+from gi.repository import Gtk  # noqa nosort
+
+from src import protocol
+from src import scrollback
+from src import settings
+from src.events import ChannelJoined
+from src.events import EndNames
+from src.events import MessageReceived
+from src.gui import ChatWindow
+from src.namegen import generate_name
+
+HOST = "irc.example.com"
+PORT = 6667
+CHANNEL = "#flood"
+LINES_PER_SECOND = 1000
+SECONDS = 10
+PROBE_INTERVAL = 10
+
+
+def main():
+    os.chdir(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+    # no network, the lines come from the timeout below
+    protocol.connect = lambda *args, **kwargs: None
+    # a fresh window, not whatever the last session was
+    settings.SESSION_SNAPSHOT = None
+
+    window = ChatWindow()
+    window.show_all()
+
+    nicks = [generate_name() for _ in range(200)]
+    protocol.bus.publish(ChannelJoined(HOST, PORT, CHANNEL))
+    protocol.bus.publish(EndNames(HOST, PORT, CHANNEL, dict.fromkeys(nicks, "")))
+
+    start = time.perf_counter()
+    sent = 0
+    delays = []
+    expected = start + PROBE_INTERVAL / 1000
+
+    def flood():
+        nonlocal sent
+        elapsed = time.perf_counter() - start
+        if elapsed > SECONDS:
+            Gtk.main_quit()
+            return GLib.SOURCE_REMOVE
+        # catch up with however many lines should have arrived by now
+        while sent < elapsed * LINES_PER_SECOND:
+            nick = nicks[sent % len(nicks)]
+            other = nicks[(sent * 7) % len(nicks)]
+            message = f"{other}: line {sent} https://example.com/{sent}"
+            protocol.bus.publish(
+                MessageReceived(HOST, PORT, CHANNEL, nick, message, time.time())
+            )
+            sent += 1
+        return GLib.SOURCE_CONTINUE
+
+    def probe():
+        nonlocal expected
+        now = time.perf_counter()
+        delays.append(max(now - expected, 0.0))
+        expected = now + PROBE_INTERVAL / 1000
+        return GLib.SOURCE_CONTINUE
+
+    GLib.timeout_add(1, flood)
+    GLib.timeout_add(PROBE_INTERVAL, probe)
+    Gtk.main()
+
+    delays.sort()
+    print(f"{sent} lines in {SECONDS}s, main loop latency:")
+    print(f"  median {statistics.median(delays) * 1000:8.2f} ms")
+    print(f"  p99    {delays[int(len(delays) * 0.99)] * 1000:8.2f} ms")
+    print(f"  max    {delays[-1] * 1000:8.2f} ms")
+    print(f"event queue: {window.events.stats()}")
+    print(f"scrollback: {scrollback.stats()}")
+
+
+if __name__ == "__main__":
+    main()
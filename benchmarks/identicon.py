@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Compares rendering identicons one name at a time against rendering them for a
+# whole channel at once, as the background workers do.
+# Run with: python -m benchmarks.identicon
+import os
+import os.path
+import timeit
+
+import numpy
+
+from src import identicon
+from src.namegen import generate_name
+
+
+def main():
+    os.chdir(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+    names = list({f"{generate_name()}{i}" for i in range(5000)})
+    keys = list({(*identicon.identicon_key(name), 1) for name in names})
+    identicon.load_layers()
+    identicon._layer_pairs()
+
+    def per_name():
+        for key in keys:
+            identicon.render_identicon(*key).tobytes()
+
+    def batch():
+        for i in range(0, len(keys), 256):
+            identicon._render_batch(keys[i : i + 256])
+
+    print(f"{len(keys)} identicons:")
+    for name, function in (("per name", per_name), ("batch", batch)):
+        seconds = min(timeit.repeat(function, number=1, repeat=3))
+        print(f"  {name:10} {seconds * 1000:8.2f} ms")
+
+    batched = identicon.composite_identicons(keys[:256])
+    single = numpy.array(
+        [numpy.asarray(identicon.render_identicon(*key)) for key in keys[:256]]
+    )
+    difference = numpy.abs(batched.astype(int) - single).max()
+    print(f"largest difference between the two: {difference}")
+
+
+if __name__ == "__main__":
+    main()
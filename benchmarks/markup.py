@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Compares the single pass tokenizer in src.markup against the regex based
+# markup_urls/markup_names it replaced. Run with: python -m benchmarks.markup
+import random
+import re
+import timeit
+
+from src.colors import name_to_color
+from src.markup import markup
+from src.markup import NickMatcher
+from src.markup import render
+from src.markup import tokenize
+from src.namegen import generate_name
+
+from gi.repository import GLib  # noqa nosort
+
+
+def legacy_markup_names(text, names, additional_markup=GLib.markup_escape_text):
+    output = []
+    regex = "|".join(re.escape(name) for name in names)
+    matches = re.finditer(regex, text)
+    offset = 0
+    for m in matches:
+        output.append(additional_markup(text[offset : m.start()]))
+        escaped_name = GLib.markup_escape_text(m[0])
+        color = name_to_color(m[0])
+        output.append('<span color="' + color + '">' + escaped_name + "</span>")
+        offset = m.end()
+    output.append(additional_markup(text[offset:]))
+    return "".join(output)
+
+
+def legacy_markup_urls(text, additional_markup=GLib.markup_escape_text):
+    output = []
+    matches = re.finditer(
+        r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+",
+        text,
+    )
+    offset = 0
+    for m in matches:
+        output.append(additional_markup(text[offset : m.start()]))
+        escaped_url = GLib.markup_escape_text(m[0])
+        output.append('<a href="' + escaped_url + '">' + escaped_url + "</a>")
+        offset = m.end()
+    output.append(additional_markup(text[offset:]))
+    return "".join(output)
+
+
+def make_lines(names, count):
+    words = "the a quick brown fox jumps over lazy dog & <tag> is it ok".split()
+    lines = []
+    for _ in range(count):
+        line = [random.choice(words) for _ in range(random.randint(3, 20))]
+        if random.random() < 0.5:
+            line.insert(0, random.choice(names) + ":")
+        if random.random() < 0.2:
+            line.append(f"https://example.com/{random.randint(0, 1000)}?a=1&b=2")
+        lines.append(" ".join(line))
+    return lines
+
+
+def main():
+    random.seed(0)
+    for channel_size in (10, 200, 2000):
+        names = list({generate_name() for _ in range(channel_size)})
+        matcher = NickMatcher(names)
+        lines = make_lines(names, 1000)
+
+        def legacy():
+            for line in lines:
+                legacy_markup_urls(line, lambda text: legacy_markup_names(text, names))
+
+        def uncached():
+            for line in lines:
+                render(tokenize(line, matcher))
+
+        def cached():
+            for line in lines:
+                markup(line, matcher)
+
+        cached()
+        results = {
+            "legacy": min(timeit.repeat(legacy, number=1, repeat=3)),
+            "tokenizer": min(timeit.repeat(uncached, number=1, repeat=3)),
+            "tokenizer, cached": min(timeit.repeat(cached, number=1, repeat=3)),
+        }
+        print(f"{len(names)} names, {len(lines)} lines:")
+        for name, seconds in results.items():
+            print(f"  {name:20} {seconds * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Feeds the message log 10000 lines per second for 10 seconds, the way the
+# protocol would, and measures how much of that time the main loop spends on
+# logging and whether the writer thread keeps up.
+# Run with: python -m benchmarks.messagelog
+import os.path
+import tempfile
+import time
+
+from src.events import EventBus
+from src.events import MessageReceived
+from src.messagelog import MessageLog
+from src.namegen import generate_name
+
+from twisted.internet import task  # noqa nosort
+
+HOST = "irc.example.com"
+PORT = 6667
+CHANNELS = [f"#channel{i}" for i in range(50)]
+LINES_PER_SECOND = 10000
+SECONDS = 10
+
+
+def main():
+    nicks = [generate_name() for _ in range(500)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "log.sqlite3")
+        clock = task.Clock()
+        bus = EventBus()
+        log = MessageLog(path, clock)
+        log.subscribe(bus)
+
+        start = time.perf_counter()
+        sent = 0
+        busy = 0.0
+        backlog = 0
+        while True:
+            elapsed = time.perf_counter() - start
+            if elapsed > SECONDS:
+                break
+            before = time.perf_counter()
+            # catch up with however many lines should have arrived by now
+            while sent < elapsed * LINES_PER_SECOND:
+                nick = nicks[sent % len(nicks)]
+                channel = CHANNELS[sent % len(CHANNELS)]
+                message = f"{nicks[(sent * 7) % len(nicks)]}: line {sent}"
+                bus.publish(
+                    MessageReceived(HOST, PORT, channel, nick, message, time.time())
+                )
+                sent += 1
+            clock.advance(elapsed - clock.seconds())
+            busy += time.perf_counter() - before
+            backlog = max(backlog, sent - log.written - log.stats()["pending"])
+            time.sleep(0.001)
+
+        before = time.perf_counter()
+        log.flush().result()
+        drained = time.perf_counter() - before
+        log.close()
+        size = os.path.getsize(path)
+
+    print(f"{sent} lines in {SECONDS}s ({sent / SECONDS:,.0f} lines/s):")
+    print(f"  main loop    {busy / sent * 1e6:8.2f} us/line publishing and logging")
+    print(f"  backlog      {backlog:8} lines at most on the writer thread")
+    print(f"  final flush  {drained * 1000:8.2f} ms")
+    print(f"  written      {log.written:8} lines in {log.transactions} transactions")
+    print(f"  database     {size / 1e6:8.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Compares parsing incoming lines with Twisted's parsemsg against our own
+# parse_line, over a recorded corpus (one raw line per line, as received) or a
+# generated one that looks like a busy channel with IRCv3 tags.
+# Run with: python -m benchmarks.parser [corpus.txt]
+import random
+import sys
+import timeit
+
+from src import protocol
+from src.namegen import generate_name
+
+from twisted.words.protocols import irc  # noqa nosort
+
+
+def generate_corpus(count):
+    rng = random.Random(0)
+    nicks = [f"{generate_name()}{i}" for i in range(300)]
+    prefixes = [f"{nick}!~{nick[:8]}@user/{nick}" for nick in nicks]
+    lines = []
+    for i in range(count):
+        prefix = rng.choice(prefixes)
+        tags = f"@time=2021-06-01T12:{i // 600 % 60:02d}:{i // 10 % 60:02d}.000Z"
+        tags += f";msgid=abc{i:08d};account={nick_of(prefix)}"
+        kind = rng.random()
+        if kind < 0.8:
+            text = " ".join(rng.choice(nicks) for _ in range(rng.randint(1, 12)))
+            lines.append(f"{tags} :{prefix} PRIVMSG #channel :{text}")
+        elif kind < 0.85:
+            lines.append(f"{tags} :{prefix} NOTICE #channel :notice {i}")
+        elif kind < 0.9:
+            lines.append(f"{tags} :{prefix} JOIN #channel * :{nick_of(prefix)}")
+        elif kind < 0.95:
+            lines.append(f"{tags} :{prefix} QUIT :Quit: leaving")
+        else:
+            names = " ".join(rng.choice(nicks) for _ in range(50))
+            lines.append(f":irc.example.com 353 me = #channel :{names}")
+    return lines
+
+
+def nick_of(prefix):
+    return prefix.split("!")[0]
+
+
+def before(lines):
+    # what lineReceived did on top of Twisted: split off the tags, then
+    # parsemsg, then split the prefix in every handler
+    for line in lines:
+        tags = {}
+        if line.startswith("@"):
+            raw_tags, _, line = line.partition(" ")
+            tags = protocol.parse_tags(raw_tags[1:])
+        prefix, command, params = irc.parsemsg(irc.lowDequote(line))
+        command = irc.numeric_to_symbolic.get(command, command)
+        nick_of(prefix)
+
+
+def after(lines):
+    for line in lines:
+        tags, prefix, command, params = protocol.parse_line(line)
+        command = irc.numeric_to_symbolic.get(command, command)
+        protocol.nick_of(prefix)
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding="utf-8", errors="replace") as f:
+            lines = [line.rstrip("\r\n") for line in f if line.strip()]
+    else:
+        lines = generate_corpus(100000)
+
+    print(f"{len(lines)} lines:")
+    for name, function in (("before", before), ("after", after)):
+        seconds = min(timeit.repeat(lambda: function(lines), number=1, repeat=5))
+        print(f"  {name:10} {len(lines) / seconds:12,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
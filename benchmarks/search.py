@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Fills a message log with a few million generated lines (or reuses an existing
+# one) and times searches over it, with and without filters, and paging.
+# Run with: python -m benchmarks.search [log.sqlite3] [lines]
+import os.path
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from src.messagelog import MESSAGE
+from src.messagelog import MessageLog
+from src.messagelog import parse_search
+from src.namegen import generate_name
+
+from twisted.internet import task  # noqa nosort
+
+SERVER = "irc.example.com:6667"
+CHANNELS = [f"#channel{i}" for i in range(200)]
+# the same words every time, so an existing log can be searched again
+random.seed(0)
+WORDS = [generate_name().lower() for _ in range(20000)]
+BATCH = 100000
+
+
+def fill(log, count):
+    rng = random.Random(0)
+    nicks = [generate_name() for _ in range(2000)]
+    start = time.time() - count
+    for i in range(0, count, BATCH):
+        rows = []
+        for j in range(i, min(i + BATCH, count)):
+            # a few common words and a long tail, roughly like chat
+            words = [rng.choice(WORDS[: 50 if rng.random() < 0.5 else None])]
+            words += rng.choices(WORDS, k=rng.randint(2, 12))
+            rows.append(
+                (
+                    SERVER,
+                    rng.choice(CHANNELS),
+                    start + j,
+                    MESSAGE,
+                    rng.choice(nicks),
+                    " ".join(words),
+                    None,
+                )
+            )
+        log._executor.submit(log._write, rows).result()
+        print(f"  {min(i + BATCH, count)} lines", end="\r")
+    print()
+
+
+def measure(log, text, pages=1):
+    query = parse_search(text)
+    times = []
+    for _ in range(5):
+        before = time.perf_counter()
+        before_id = None
+        for _ in range(pages):
+            results = log.search(query, before_id).result()
+            if results:
+                before_id = results[-1].id
+        times.append(time.perf_counter() - before)
+    print(
+        f"  {text!r:40} {statistics.median(times) * 1000:8.2f} ms"
+        f"  ({len(results)} results on page {pages})"
+    )
+
+
+def main():
+    directory = None
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, "log.sqlite3")
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000000
+
+    existing = os.path.exists(path)
+    log = MessageLog(path, task.Clock())
+    if not existing:
+        print(f"writing {count} lines to {path}")
+        before = time.perf_counter()
+        fill(log, count)
+        print(f"  {count / (time.perf_counter() - before):,.0f} lines/s")
+
+    common = WORDS[0]
+    rare = WORDS[-1]
+    print("searching:")
+    measure(log, common)
+    measure(log, common, pages=5)
+    measure(log, rare)
+    measure(log, f"{common} {rare}")
+    measure(log, f"{common[:3]}*")
+    measure(log, f"in:{CHANNELS[7]} {common}")
+    measure(log, f"in:{CHANNELS[7]} {rare}")
+    measure(log, f"after:2000-01-01 {rare}")
+    measure(log, "nosuchword")
+    log.close()
+    if directory is not None:
+        directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
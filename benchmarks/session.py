@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Measures saving and loading a session snapshot of 200 channels, and the time
+# from reading it to the restored window being drawn for the first time. The
+# last part needs a display, and is skipped with --no-window.
+# Run with: python -m benchmarks.session [--no-window]
+import os.path
+import sys
+import tempfile
+import time
+
+from src import session
+from src.namegen import generate_name
+from src.scrollback import MESSAGE
+
+HOST = "irc.example.com"
+PORT = 6667
+CHANNELS = 200
+MEMBERS = 300
+LINES = 100
+
+
+def make_snapshot():
+    nicks = [generate_name() for _ in range(MEMBERS * 2)]
+    channels = []
+    for i in range(CHANNELS):
+        members = {nick: "" for nick in nicks[i % MEMBERS : i % MEMBERS + MEMBERS]}
+        channels.append(
+            {
+                "host": HOST,
+                "port": PORT,
+                "key": f"#channel{i}",
+                "channel": f"#channel{i}",
+                "topic": f"Welcome to #channel{i} https://example.com/{i}",
+                "members": members,
+                "lines": [
+                    [
+                        MESSAGE,
+                        nicks[(i + j) % len(nicks)],
+                        f"{nicks[j % len(nicks)]}: line {j}",
+                        1600000000.0 + j,
+                        f"msgid{i}-{j}",
+                    ]
+                    for j in range(LINES)
+                ],
+                "unread": i % 7,
+                "highlights": i % 3,
+            }
+        )
+    return {
+        "servers": [{"host": HOST, "port": PORT, "nickname": "me", "channels": []}],
+        "channels": channels,
+        "visible": f"{HOST}:{PORT}/#channel0",
+    }
+
+
+def measure_window(path):
+    os.chdir(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+    from src import versions  # noqa nosort
+    from gi.repository import GLib  # noqa nosort
+    from gi.repository import Gtk  # noqa nosort
+
+    from src import protocol
+    from src import settings
+    from src.gui import ChatWindow
+
+    # no network, only what's in the snapshot
+    protocol.connect = lambda *args, **kwargs: None
+    settings.SESSION_SNAPSHOT = path
+
+    drawn = None
+
+    def on_draw(widget, cr):
+        nonlocal drawn
+        if drawn is None:
+            drawn = time.perf_counter()
+            GLib.idle_add(Gtk.main_quit)
+        return False
+
+    start = time.perf_counter()
+    window = ChatWindow()
+    constructed = time.perf_counter()
+    window.connect_after("draw", on_draw)
+    window.show_all()
+    Gtk.main()
+    print(f"  window       {(constructed - start) * 1000:8.2f} ms to restore")
+    print(f"  first draw   {(drawn - start) * 1000:8.2f} ms after reading the snapshot")
+
+
+def main():
+    snapshot = make_snapshot()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.json")
+        before = time.perf_counter()
+        session.save(path, snapshot)
+        saved = time.perf_counter()
+        session.load(path)
+        loaded = time.perf_counter()
+
+        print(f"{CHANNELS} channels, {MEMBERS} members and {LINES} lines each:")
+        print(f"  size         {os.path.getsize(path) / 1e6:8.2f} MB")
+        print(f"  save         {(saved - before) * 1000:8.2f} ms")
+        print(f"  load         {(loaded - saved) * 1000:8.2f} ms")
+        if "--no-window" not in sys.argv:
+            measure_window(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Measures how long the client takes to start, in fresh interpreters: what each
+# module costs to import (python -X importtime, as the median of a few runs)
+# and the time from starting the interpreter to the window being drawn for the
+# first time, without any network. With --restore the window is restored from
+# the session snapshot benchmarks.session makes, otherwise it starts without
+# one. The window needs a display, and is skipped with --no-window, which only
+# does the imports.
+# Run with: python -m benchmarks.startup [--no-window] [--restore] [runs]
+import os.path
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src")
+SLOWEST = 25
+
+
+def child(directory, window):
+    # what entry.py imports, then what main() does
+    from src import main  # noqa
+
+    print("imported", flush=True)
+    if not window:
+        return
+
+    from src import protocol
+    from src import settings
+    from src.gui import ChatWindow
+
+    os.chdir(SRC)
+    # only the session main() wrote, if any, and a log of its own
+    protocol.connect = lambda *args, **kwargs: None
+    snapshot = os.path.join(directory, "session.json")
+    settings.SESSION_SNAPSHOT = snapshot if os.path.exists(snapshot) else None
+    settings.MESSAGE_LOG = os.path.join(directory, "log.sqlite3")
+
+    drawn = False
+
+    def on_draw(widget, cr):
+        nonlocal drawn
+        if not drawn:
+            drawn = True
+            print("drawn", flush=True)
+            protocol.stop()
+        return False
+
+    w = ChatWindow()
+    w.connect_after("draw", on_draw)
+    w.show_all()
+    protocol.start()
+
+
+def run(directory, window):
+    # returns the times from starting the interpreter to the imports being done
+    # and to the first frame, and {module: (self, cumulative, depth)} in seconds
+    import re
+    import subprocess
+
+    command = [sys.executable, "-X", "importtime", "-m", "benchmarks.startup"]
+    command += ["--child", directory] + ([] if window else ["--no-window"])
+    times = {}
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        cwd=os.path.join(SRC, ".."),
+    )
+    for line in process.stdout:
+        times[line.strip()] = time.perf_counter() - start
+    stderr = process.stderr.read()
+    if process.wait() != 0 or "imported" not in times:
+        sys.exit("the client did not start:\n" + stderr)
+
+    modules = {}
+    for match in re.finditer(
+        r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$", stderr, re.MULTILINE
+    ):
+        own, cumulative, indent, name = match.groups()
+        modules[name] = (int(own) / 1e6, int(cumulative) / 1e6, len(indent) // 2)
+    return times.get("imported"), times.get("drawn"), modules
+
+
+def main():
+    # imported here, so they don't count towards the child's import times
+    import collections
+    import statistics
+    import tempfile
+
+    from benchmarks.session import make_snapshot
+    from src import session
+
+    window = "--no-window" not in sys.argv
+    numbers = [arg for arg in sys.argv[1:] if arg.isdigit()]
+    runs = int(numbers[0]) if numbers else 5
+
+    imported = []
+    drawn = []
+    modules = collections.defaultdict(list)
+    with tempfile.TemporaryDirectory() as directory:
+        if "--restore" in sys.argv:
+            session.save(os.path.join(directory, "session.json"), make_snapshot())
+        # the first run fills the disk cache and writes the .pyc files
+        run(directory, window)
+        for _ in range(runs):
+            imported_time, drawn_time, run_modules = run(directory, window)
+            imported.append(imported_time)
+            drawn.append(drawn_time)
+            for name, times in run_modules.items():
+                modules[name].append(times)
+
+    def median(name, index):
+        return statistics.median(times[index] for times in modules[name])
+
+    print(f"startup, median of {runs} runs:")
+    print(f"  imports      {statistics.median(imported) * 1000:8.2f} ms")
+    if window:
+        print(f"  first frame  {statistics.median(drawn) * 1000:8.2f} ms")
+
+    packages = collections.Counter()
+    for name in modules:
+        packages[name.split(".")[0]] += median(name, 0)
+    print("importing, by package (self time):")
+    for package, seconds in packages.most_common(SLOWEST):
+        print(f"  {package:48} {seconds * 1000:8.2f} ms")
+
+    print("slowest modules (cumulative, indented by who imported them):")
+    slowest = sorted(modules, key=lambda name: median(name, 1), reverse=True)
+    for name in slowest[:SLOWEST]:
+        depth = modules[name][0][2]
+        label = "  " * depth + name
+        print(f"  {label:48} {median(name, 1) * 1000:8.2f} ms")
+
+    print("the client's own modules (cumulative):")
+    for name in slowest:
+        if name == "src" or name.startswith("src."):
+            print(f"  {name:48} {median(name, 1) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        child(sys.argv[sys.argv.index("--child") + 1], "--no-window" not in sys.argv)
+    else:
+        main()
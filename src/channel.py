@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+import time
+
+from . import protocol
+from . import settings
+from .completion import CompletionIndex
+from .events import ActionReceived
+from .events import Batch
+from .events import EndNames
+from .events import MessageReceived
+from .events import NoticeReceived
+from .events import PrefixChanged
+from .events import TopicChanged
+from .events import UserJoined
+from .events import UserKicked
+from .events import UserLeft
+from .events import UserQuit
+from .events import UserRenamed
+from .markup import mentions
+from .markup import NickMatcher
+from .scrollback import ACTION
+from .scrollback import ERROR
+from .scrollback import Line
+from .scrollback import MESSAGE
+from .scrollback import NOTICE
+from .scrollback import Scrollback
+from .scrollback import Spill
+
+# what changed, passed to the listeners of a channel
+TOPIC = "topic"
+MEMBERS = "members"
+UNREAD = "unread"
+
+
+class ChannelModel:
+    # everything about a channel (or a private conversation) that doesn't need
+    # widgets, so channels in the background cost next to nothing. the widgets
+    # are only made when the channel is shown, see gui.Channel.
+    def __init__(self, channel_id, channel, bus):
+        self.id = channel_id
+        host, port = self.host, self.port = channel_id.server
+        self.channel = channel
+        self.bus = bus
+        self.topic = None
+        # everyone in the channel, mapped to their prefixes (e.g. "@+"). the
+        # matcher and the completions know everyone as well, and find them
+        # whatever the case.
+        self.members = {}
+        fold = protocol.casemapping(host, port).fold
+        self.matcher = NickMatcher(normalize=fold)
+        self.completions = CompletionIndex(normalize=fold)
+        # lines that came in while the channel wasn't shown, and how many of
+        # those mention us (in private conversations, all of them do)
+        self.visible = False
+        self.unread = 0
+        self.highlights = 0
+        self._listeners = []
+
+        spill = Spill() if settings.SCROLLBACK_SPILL_TO_DISK else None
+        self.scrollback = Scrollback(
+            str(channel_id),
+            settings.SCROLLBACK_MAX_LINES,
+            settings.SCROLLBACK_MAX_BYTES,
+            spill,
+        )
+
+        server, channel = channel_id
+        self.subscriptions = [
+            bus.subscribe(EndNames, self.on_end_names, server, channel),
+            bus.subscribe(MessageReceived, self.on_message_received, server, channel),
+            bus.subscribe(ActionReceived, self.on_action_received, server, channel),
+            bus.subscribe(NoticeReceived, self.on_notice_received, server, channel),
+            bus.subscribe(TopicChanged, self.on_topic_changed, server, channel),
+            bus.subscribe(UserJoined, self.on_user_joined, server, channel),
+            bus.subscribe(UserLeft, self.on_user_left, server, channel),
+            bus.subscribe(UserKicked, self.on_user_left, server, channel),
+            bus.subscribe(UserQuit, self.on_user_left, server, channel),
+            bus.subscribe(UserRenamed, self.on_user_renamed, server, channel),
+            bus.subscribe(PrefixChanged, self.on_prefix_changed, server, channel),
+            bus.subscribe(Batch, self.on_history, server, channel),
+        ]
+        self._history_requested = None
+        if protocol.supports_history(host, port):
+            self.scrollback.set_loader(self.load_history)
+
+    @property
+    def is_private(self):
+        return self.channel[:1] not in "#&"
+
+    def connect(self, callback):
+        # callback(model, change) with change being TOPIC, MEMBERS or UNREAD
+        self._listeners.append(callback)
+
+    def disconnect(self, callback):
+        self._listeners.remove(callback)
+
+    def _notify(self, change):
+        for callback in tuple(self._listeners):
+            callback(self, change)
+
+    def close(self):
+        for subscription in self.subscriptions:
+            self.bus.unsubscribe(subscription)
+        self.subscriptions = []
+        self.scrollback.close()
+
+    def set_visible(self, visible):
+        self.visible = visible
+        if visible and self.unread:
+            self.unread = self.highlights = 0
+            self._notify(UNREAD)
+
+    def _count_unread(self, event):
+        if self.visible:
+            return
+        nick = protocol.nickname(self.host, self.port)
+        fold = self.matcher.normalize
+        if nick is not None and fold(event.user) == fold(nick):
+            return
+        self.unread += 1
+        if self.is_private or (
+            nick is not None and mentions(event.message, nick, fold)
+        ):
+            self.highlights += 1
+        self._notify(UNREAD)
+
+    def snapshot(self, max_lines):
+        # what restore() needs to show the channel again, see session.py
+        scrollback = self.scrollback
+        start = max(scrollback.start, scrollback.end - max_lines)
+        lines = (scrollback.get(index) for index in range(start, scrollback.end))
+        return {
+            "host": self.host,
+            "port": self.port,
+            "key": self.id.key,
+            "channel": self.channel,
+            "topic": self.topic,
+            "members": self.members,
+            "lines": [list(line) for line in lines if line.kind != ERROR],
+            "unread": self.unread,
+            "highlights": self.highlights,
+        }
+
+    def restore(self, state):
+        # until the server tells us otherwise, things are like they were
+        self.topic = state["topic"]
+        self.members = dict(state["members"])
+        self.matcher.reset(self.members)
+        self.completions.reset(self.members)
+        lines = [Line(*line) for line in state["lines"]]
+        for line in lines:
+            if line.kind != NOTICE and line.time is not None:
+                self.completions.spoke(line.author, line.time)
+        self.scrollback.extend(lines)
+        self.unread = state["unread"]
+        self.highlights = state["highlights"]
+
+    def update_server(self):
+        # restored channels are made before there's a connection, so how the
+        # server folds nicks and whether it has history are looked at again
+        # once it's there
+        fold = protocol.casemapping(self.host, self.port).fold
+        self.matcher.set_normalize(fold)
+        self.completions.set_normalize(fold)
+        if protocol.supports_history(self.host, self.port):
+            if self.scrollback.loader is None:
+                self.scrollback.set_loader(self.load_history)
+
+    def send_command(self, command, args):
+        # a restored window takes input before the server's connected
+        try:
+            self._send_command(command.lower(), args)
+        except ValueError as e:
+            self.scrollback.add_error(str(e))
+
+    def _send_command(self, command, args):
+        if command == "say":
+            protocol.send_message(self.host, self.port, self.channel, args)
+        elif command == "me":
+            if not args:
+                return
+            protocol.send_action(self.host, self.port, self.channel, args)
+        elif command == "nick":
+            if " " in args:
+                self.scrollback.add_error("Nickname cannot contain spaces")
+                return
+            protocol.change_nick(args)
+        elif command == "join":
+            if " " in args:
+                self.scrollback.add_error("Channel name cannot contain spaces")
+                return
+            if "," in args:
+                self.scrollback.add_error("Channel name cannot contain commas")
+                return
+            if "\x07" in args:
+                self.scrollback.add_error("Channel name cannot contain bell characters")
+                return
+
+            if args[0] not in "#&":
+                args = "#" + args
+
+            protocol.join_channel(self.host, self.port, args)
+        else:
+            self.scrollback.add_error(f'Unknown command "{command}"')
+
+    def load_history(self, scrollback, count):
+        # the answer may never come, so don't wait for it forever
+        requested = self._history_requested
+        if requested is not None and time.monotonic() - requested < 10:
+            return
+        self._history_requested = time.monotonic()
+        # error and status lines have neither, and without a reference the
+        # server would send the latest lines instead of older ones
+        first = None
+        for index in range(scrollback.start, scrollback.end):
+            line = scrollback.get(index)
+            if line.msgid is not None or line.time is not None:
+                first = line
+                break
+        try:
+            protocol.request_history(
+                self.host,
+                self.port,
+                self.channel,
+                count,
+                first and first.msgid,
+                first and first.time,
+            )
+        except ValueError as e:
+            self.scrollback.add_error(str(e))
+
+    def on_history(self, event):
+        # a page of the server's history, either the latest lines requested on
+        # joining or the ones before the first line here
+        self._history_requested = None
+        kinds = {
+            MessageReceived: MESSAGE,
+            ActionReceived: ACTION,
+            NoticeReceived: NOTICE,
+        }
+        lines = [
+            Line(kinds[type(e)], e.user, e.message, e.time, e.msgid)
+            for e in event.events
+            if type(e) in kinds
+        ]
+        if not lines:
+            self.scrollback.set_loader(None)
+            return
+        for line in lines:
+            if line.kind != NOTICE:
+                self.completions.spoke(line.author, line.time)
+        # newer lines are what was missed while disconnected (or closed)
+        self.scrollback.merge_newer(lines)
+        self.scrollback.merge_older(lines)
+
+    def on_end_names(self, event):
+        self.members = event.members
+        self.matcher.reset(self.members)
+        self.completions.reset(self.members)
+        self._notify(MEMBERS)
+
+    def on_message_received(self, event):
+        self.completions.spoke(event.user, event.time)
+        self.scrollback.add_message(event.user, event.message, event.time, event.msgid)
+        self._count_unread(event)
+
+    def on_action_received(self, event):
+        self.completions.spoke(event.user, event.time)
+        self.scrollback.add_action(event.user, event.message, event.time, event.msgid)
+        self._count_unread(event)
+
+    def on_notice_received(self, event):
+        self.scrollback.add_notice(event.user, event.message, event.time, event.msgid)
+
+    def on_topic_changed(self, event):
+        self.topic = event.topic
+        self._notify(TOPIC)
+
+    def on_user_joined(self, event):
+        self.members.pop(self.matcher.lookup(event.user), None)
+        self.members[event.user] = ""
+        self.matcher.add(event.user)
+        self.completions.add(event.user)
+
+    def on_user_left(self, event):
+        # also used for kicks and quits
+        user = self.matcher.lookup(event.user)
+        if user is not None:
+            del self.members[user]
+            self.matcher.remove(user)
+            self.completions.remove(user)
+
+    def on_user_renamed(self, event):
+        old_user = self.matcher.lookup(event.old_user)
+        if old_user is not None:
+            self.members[event.new_user] = self.members.pop(old_user)
+            self.matcher.rename(old_user, event.new_user)
+            self.completions.rename(old_user, event.new_user)
+
+    def on_prefix_changed(self, event):
+        user = self.matcher.lookup(event.user)
+        if user is not None:
+            self.members[user] = event.prefixes
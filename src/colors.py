@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import zlib
+
 # TODO: generate CSS colors from this file
 
 name = {
@@ -93,3 +95,13 @@ name = {
     352: "#e2008d",
     356: "#e40084",
 }
+
+
+def name_to_color_class(nick):
+    hue = zlib.crc32(nick.encode("utf-8")) * 90 // 0xFFFFFFFF * 4
+    return f"label_color_h{hue:02d}"
+
+
+def name_to_color(nick):
+    hue = zlib.crc32(nick.encode("utf-8")) * 90 // 0xFFFFFFFF * 4
+    return name[hue]
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import bisect
+import heapq
+
+
+class CompletionIndex:
+    # nicknames for tab completion. the normalized nicks are kept sorted, so
+    # the ones starting with what was typed are next to each other and can be
+    # found with a binary search instead of checking everyone. joins, parts and
+    # renames update the index in place.
+    def __init__(self, nicks=(), normalize=str.lower):
+        self.normalize = normalize
+        self._keys = []
+        self._nicks = {}
+        # when each nick last said something, in seconds since the epoch
+        self._spoke = {}
+        self.reset(nicks)
+
+    def __contains__(self, nick):
+        return self.normalize(nick) in self._nicks
+
+    def __len__(self):
+        return len(self._keys)
+
+    def reset(self, nicks):
+        normalize = self.normalize
+        self._nicks = {normalize(nick): nick for nick in nicks}
+        self._keys = sorted(self._nicks)
+        self._spoke = {
+            key: time for key, time in self._spoke.items() if key in self._nicks
+        }
+
+    def set_normalize(self, normalize):
+        # keeps the nicks and when they spoke, keyed the new way
+        nicks = list(self._nicks.values())
+        spoke = [(self._nicks[key], time) for key, time in self._spoke.items()]
+        self.normalize = normalize
+        self._spoke = {}
+        self.reset(nicks)
+        for nick, time in spoke:
+            self.spoke(nick, time)
+
+    def add(self, nick):
+        key = self.normalize(nick)
+        if key not in self._nicks:
+            bisect.insort(self._keys, key)
+        self._nicks[key] = nick
+
+    def remove(self, nick):
+        key = self.normalize(nick)
+        if self._nicks.pop(key, None) is not None:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+            self._spoke.pop(key, None)
+
+    def rename(self, old_nick, new_nick):
+        spoke = self._spoke.get(self.normalize(old_nick))
+        self.remove(old_nick)
+        self.add(new_nick)
+        if spoke is not None:
+            self._spoke[self.normalize(new_nick)] = spoke
+
+    def spoke(self, nick, time):
+        # time can be older than what we know already, e.g. for history
+        key = self.normalize(nick)
+        if key in self._nicks and time > self._spoke.get(key, 0):
+            self._spoke[key] = time
+
+    def by_recency(self):
+        # every nick, whoever spoke most recently first and then the ones that
+        # haven't said anything
+        spoke = self._spoke
+        for key in sorted(spoke, key=spoke.get, reverse=True):
+            yield self._nicks[key]
+        for key, nick in self._nicks.items():
+            if key not in spoke:
+                yield nick
+
+    def complete(self, prefix, limit=20):
+        # the nicks starting with prefix, whoever spoke most recently first,
+        # then alphabetically
+        prefix = self.normalize(prefix)
+        keys = self._keys
+        start = bisect.bisect_left(keys, prefix)
+        end = start
+        while end < len(keys) and keys[end].startswith(prefix):
+            end += 1
+        spoke = self._spoke
+        best = heapq.nsmallest(
+            limit, keys[start:end], key=lambda key: (-spoke.get(key, 0), key)
+        )
+        return [self._nicks[key] for key in best]
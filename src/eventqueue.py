@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import collections
+import time
+
+
+class EventQueue:
+    # events from the network are only appended here, and handed to deliver()
+    # in batches once per frame, for at most `budget` seconds per frame. time
+    # a frame didn't need is carried over to the next one (up to max_carry),
+    # so a burst right after a quiet period drains quicker.
+    BATCH_SIZE = 64
+
+    def __init__(self, deliver, budget=0.008, max_carry=0.008):
+        self.deliver = deliver
+        self.budget = budget
+        self.max_carry = max_carry
+        self._events = collections.deque()
+        self._carry = 0.0
+        self.delivered = 0
+        self.frames = 0
+
+    def __len__(self):
+        return len(self._events)
+
+    def push(self, event):
+        self._events.append(event)
+
+    def drain(self):
+        # returns whether there are events left for the next frame
+        start = time.perf_counter()
+        budget = self.budget + self._carry
+        deadline = start + budget
+        events = self._events
+        while events:
+            count = min(self.BATCH_SIZE, len(events))
+            self.deliver([events.popleft() for _ in range(count)])
+            self.delivered += count
+            if time.perf_counter() >= deadline:
+                break
+        used = time.perf_counter() - start
+        self._carry = min(max(budget - used, 0.0), self.max_carry)
+        self.frames += 1
+        return bool(events)
+
+    def stats(self):
+        return {
+            "queued": len(self._events),
+            "delivered": self.delivered,
+            "frames": self.frames,
+        }
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+from .identity import ServerId
+
+
+class Event:
+    # events that aren't about a single channel have channel set to None. key
+    # is the channel folded with the server's casemapping, which the client
+    # sets before publishing.
+    __slots__ = ("host", "port", "channel", "key")
+
+    def __init__(self, host, port, channel=None):
+        self.host = host
+        self.port = port
+        self.channel = channel
+        self.key = channel
+
+    @property
+    def server(self):
+        return ServerId(self.host, self.port)
+
+    def __repr__(self):
+        fields = ", ".join(
+            f"{slot}={getattr(self, slot)!r}"
+            for cls in reversed(type(self).__mro__)
+            for slot in getattr(cls, "__slots__", ())
+        )
+        return f"{type(self).__name__}({fields})"
+
+
+class SignedOn(Event):
+    # the server accepted our registration, so its casemapping and the
+    # capabilities it supports are known
+    __slots__ = ()
+
+
+class ChannelJoined(Event):
+    __slots__ = ()
+
+
+class EndNames(Event):
+    # everyone in the channel once a NAMES reply is complete, mapped to their
+    # prefixes (e.g. "@+", highest first)
+    __slots__ = ("members",)
+
+    def __init__(self, host, port, channel, members):
+        super().__init__(host, port, channel)
+        self.members = members
+
+
+class MessageReceived(Event):
+    # time is in seconds since the epoch, from the server if it supports
+    # server-time. msgid is the server's id for the message, if it has one.
+    __slots__ = ("user", "message", "time", "msgid")
+
+    def __init__(self, host, port, channel, user, message, time, msgid=None):
+        super().__init__(host, port, channel)
+        self.user = user
+        self.message = message
+        self.time = time
+        self.msgid = msgid
+
+
+class ActionReceived(MessageReceived):
+    __slots__ = ()
+
+
+class NoticeReceived(MessageReceived):
+    __slots__ = ()
+
+
+class TopicChanged(Event):
+    __slots__ = ("topic",)
+
+    def __init__(self, host, port, channel, topic):
+        super().__init__(host, port, channel)
+        self.topic = topic
+
+
+class UserJoined(Event):
+    __slots__ = ("user",)
+
+    def __init__(self, host, port, channel, user):
+        super().__init__(host, port, channel)
+        self.user = user
+
+
+class UserLeft(UserJoined):
+    __slots__ = ()
+
+
+class UserKicked(UserJoined):
+    __slots__ = ("kicker", "message")
+
+    def __init__(self, host, port, channel, user, kicker, message):
+        super().__init__(host, port, channel, user)
+        self.kicker = kicker
+        self.message = message
+
+
+class UserQuit(UserJoined):
+    # published for every channel the user was in
+    __slots__ = ("message",)
+
+    def __init__(self, host, port, channel, user, message):
+        super().__init__(host, port, channel, user)
+        self.message = message
+
+
+class UserRenamed(Event):
+    # published for every channel the user is in
+    __slots__ = ("old_user", "new_user")
+
+    def __init__(self, host, port, channel, old_user, new_user):
+        super().__init__(host, port, channel)
+        self.old_user = old_user
+        self.new_user = new_user
+
+
+class PrefixChanged(UserJoined):
+    # prefixes are all of the user's prefixes after the change, e.g. "@+"
+    __slots__ = ("prefixes",)
+
+    def __init__(self, host, port, channel, user, prefixes):
+        super().__init__(host, port, channel, user)
+        self.prefixes = prefixes
+
+
+class UserAway(Event):
+    # message is None when the user is back
+    __slots__ = ("user", "message")
+
+    def __init__(self, host, port, user, message):
+        super().__init__(host, port)
+        self.user = user
+        self.message = message
+
+
+class Batch(Event):
+    # events the server sent as one unit (a netsplit, history playback, ...),
+    # see https://ircv3.net/specs/extensions/batch. channel is only set for
+    # batches that are about a single channel.
+    __slots__ = ("type", "params", "events")
+
+    def __init__(self, host, port, channel, type, params):
+        super().__init__(host, port, channel)
+        self.type = type
+        self.params = params
+        self.events = []
+
+
+EVENT_TYPES = (
+    SignedOn,
+    ChannelJoined,
+    EndNames,
+    MessageReceived,
+    ActionReceived,
+    NoticeReceived,
+    TopicChanged,
+    UserJoined,
+    UserLeft,
+    UserKicked,
+    UserQuit,
+    UserRenamed,
+    PrefixChanged,
+    UserAway,
+    Batch,
+)
+
+
+class EventBus:
+    # subscribers are kept per (event type, server, channel key), with None
+    # for server or channel meaning any, so publishing an event is three dict
+    # lookups no matter how many channels are open.
+    def __init__(self):
+        self._subscribers = {}
+
+    def subscribe(self, event_type, callback, server=None, channel=None):
+        # returns the subscription to pass to unsubscribe()
+        key = (event_type, server, channel)
+        self._subscribers.setdefault(key, []).append(callback)
+        return key, callback
+
+    def unsubscribe(self, subscription):
+        key, callback = subscription
+        callbacks = self._subscribers[key]
+        callbacks.remove(callback)
+        if not callbacks:
+            del self._subscribers[key]
+
+    def publish(self, event):
+        event_type = type(event)
+        server = event.server
+        keys = [(event_type, None, None), (event_type, server, None)]
+        if event.key is not None:
+            keys.append((event_type, server, event.key))
+        # the subscribers for a key are only looked up once the less specific
+        # ones have run, so those can subscribe to the event they're handling
+        # (e.g. by creating the widget for a new channel).
+        for key in keys:
+            callbacks = self._subscribers.get(key)
+            if callbacks:
+                for callback in tuple(callbacks):
+                    callback(event)
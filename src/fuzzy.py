@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import bisect
+import heapq
+import itertools
+import re
+
+
+class FuzzyIndex:
+    # finds entries whose text has the characters of the query in order, so
+    # "bch" finds "#butter-chat". all texts are kept in one string, each after
+    # a newline, so searching is str.find() and one regex scan in C over
+    # everything instead of a Python loop over every entry; only the matches
+    # are looked at in Python. adding and removing an entry splices it into
+    # (or out of) the string where it belongs, instead of building it again.
+    def __init__(self, normalize=str.lower):
+        self.normalize = normalize
+        # value -> its entry in _sorted, (length, text, counter, value). the
+        # counter keeps values from ever being compared.
+        self._entries = {}
+        self._sorted = []
+        self._counter = itertools.count()
+        self._text = None
+        self._values = []
+        # where every entry's newline is in _text
+        self._offsets = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, value, text):
+        self.remove(value)
+        text = self.normalize(text).replace("\n", " ")
+        entry = (len(text), text, next(self._counter), value)
+        i = bisect.bisect(self._sorted, entry)
+        self._sorted.insert(i, entry)
+        self._entries[value] = entry
+        if self._text is not None:
+            offset = self._offsets[i]
+            size = len(text) + 1
+            self._text = self._text[:offset] + "\n" + text + self._text[offset:]
+            self._values.insert(i, value)
+            self._offsets[i + 1 :] = [o + size for o in self._offsets[i:]]
+
+    def remove(self, value):
+        entry = self._entries.pop(value, None)
+        if entry is not None:
+            i = bisect.bisect_left(self._sorted, entry)
+            del self._sorted[i]
+            if self._text is not None:
+                offset = self._offsets[i]
+                size = entry[0] + 1
+                self._text = self._text[:offset] + self._text[offset + size :]
+                del self._values[i]
+                self._offsets[i:] = [o - size for o in self._offsets[i + 1 :]]
+
+    def _build(self):
+        # shortest first, so the first matches found are the best ones
+        entries = self._sorted
+        self._values = [entry[3] for entry in entries]
+        self._offsets = list(
+            itertools.accumulate((entry[0] + 1 for entry in entries), initial=0)
+        )
+        self._text = "".join(["\n" + entry[1] for entry in entries])
+
+    def _line(self, position):
+        return bisect.bisect_right(self._offsets, position) - 1
+
+    def _find(self, needle, found, limit):
+        text = self._text
+        position = text.find(needle)
+        while position != -1 and len(found) < limit:
+            i = self._line(position)
+            found[i] = None
+            position = text.find(needle, self._offsets[i + 1])
+
+    def search(self, query, limit=10):
+        # best first: texts starting with the query, then the ones containing
+        # it, then the ones where its characters are closest together. each of
+        # those has shorter texts first.
+        if self._text is None:
+            self._build()
+        query = "".join(self.normalize(query).split())
+        if not query:
+            return self._values[:limit]
+
+        found = {}
+        self._find("\n" + query, found, limit)
+        self._find(query, found, limit)
+        if len(found) < limit:
+            # c[^\nd]*d can't backtrack, so it's a single pass over the text
+            pattern = re.escape(query[0])
+            for c in query[1:]:
+                c = re.escape(c)
+                pattern += f"[^\n{c}]*{c}"
+            spans = {}
+            for m in re.finditer(pattern, self._text):
+                i = self._line(m.start())
+                span = m.end() - m.start()
+                if i not in found and span < spans.get(i, len(self._text)):
+                    spans[i] = span
+            found.update(
+                (i, None)
+                for i in heapq.nsmallest(
+                    limit - len(found), spans, key=lambda i: (spans[i], i)
+                )
+            )
+        return [self._values[i] for i in found]
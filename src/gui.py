@@ -1,48 +1,44 @@
 # -*- coding: utf-8 -*-
-import re
+import bisect
+import functools
+import itertools
+import time
 
 from . import protocol
-from .identicon import get_identicon
-from .identicon import name_to_color
-from .identicon import name_to_color_class
+from . import session
+from . import settings
+from .channel import ChannelModel
+from .channel import MEMBERS
+from .channel import TOPIC
+from .channel import UNREAD
+from .colors import name_to_color_class
+from .eventqueue import EventQueue
+from .events import ActionReceived
+from .events import Batch
+from .events import ChannelJoined
+from .events import EVENT_TYPES
+from .events import EventBus
+from .events import MessageReceived
+from .events import NoticeReceived
+from .events import SignedOn
+from .fuzzy import FuzzyIndex
+from .identicon import request_identicon
+from .identicon import warm_identicons
+from .identity import ChannelId
+from .identity import ServerId
+from .markup import escape
+from .markup import markup
 from .namegen import generate_name
+from .scrollback import ACTION
+from .scrollback import batched_changes
+from .scrollback import MESSAGE
+from .scrollback import NOTICE
 
 from . import versions  # noqa nosort
 from gi.repository import Gdk  # noqa nosort
 from gi.repository import GLib  # noqa nosort
-from gi.repository import GObject  # noqa nosort
 from gi.repository import Gtk  # noqa nosort
-
-
-def markup_names(text, names, additional_markup=GLib.markup_escape_text):
-    output = []
-    regex = "|".join(re.escape(name) for name in names)
-    matches = re.finditer(regex, text)
-    offset = 0
-    for m in matches:
-        output.append(additional_markup(text[offset : m.start()]))
-        escaped_name = GLib.markup_escape_text(m[0])
-        color = name_to_color(m[0])
-        output.append('<span color="' + color + '">' + escaped_name + "</span>")
-        offset = m.end()
-    output.append(additional_markup(text[offset:]))
-    return "".join(output)
-
-
-def markup_urls(text, additional_markup=GLib.markup_escape_text):
-    output = []
-    matches = re.finditer(
-        r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+",
-        text,
-    )
-    offset = 0
-    for m in matches:
-        output.append(additional_markup(text[offset : m.start()]))
-        escaped_url = GLib.markup_escape_text(m[0])
-        output.append('<a href="' + escaped_url + '">' + escaped_url + "</a>")
-        offset = m.end()
-    output.append(additional_markup(text[offset:]))
-    return "".join(output)
+from gi.repository import Pango  # noqa nosort
 
 
 def add_css_class(widget, class_):
@@ -50,12 +46,173 @@ def add_css_class(widget, class_):
     context.add_class(class_)
 
 
-class ChannelList(Gtk.StackSwitcher):
-    # TODO: make me collapsible
-    def __init__(self):
-        Gtk.StackSwitcher.__init__(self)
-        self.set_orientation(Gtk.Orientation.VERTICAL)
+class ChannelList(Gtk.ScrolledWindow):
+    # channels grouped by server. a tree view only renders the rows on screen,
+    # and with fixed height rows it doesn't have to measure the others, so
+    # this stays fast with thousands of channels. channels are identified by
+    # their name in the stack, which is str(ChannelId).
+    def __init__(self, stack):
+        Gtk.ScrolledWindow.__init__(self)
+        self.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        self.set_size_request(180, -1)
         add_css_class(self, "channel-switcher")
+        self.stack = stack
+        # title, font weight, and name in the stack (None for servers)
+        self.store = Gtk.TreeStore(str, int, str)
+        # the quick switcher searches this, see QuickSwitcher
+        self.index = FuzzyIndex()
+        # by ChannelId
+        self._pages = {}
+        self._rows = {}
+        # row of every server, and the keys of its channels in order
+        self._servers = {}
+
+        self.tree_view = Gtk.TreeView(model=self.store)
+        self.tree_view.set_headers_visible(False)
+        self.tree_view.set_enable_search(False)
+        renderer = Gtk.CellRendererText()
+        renderer.props.ellipsize = Pango.EllipsizeMode.END
+        column = Gtk.TreeViewColumn("Channel", renderer, text=0, weight=1)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_expand(True)
+        self.tree_view.append_column(column)
+        self.tree_view.set_fixed_height_mode(True)
+        self.tree_view.get_selection().connect("changed", self.on_selection_changed)
+        self.add(self.tree_view)
+
+    def _row(self, page, name):
+        model = page.model
+        weight = Pango.Weight.BOLD if model.highlights else Pango.Weight.NORMAL
+        return (page.title, weight, name)
+
+    def add_channel(self, page):
+        channel_id = page.model.id
+        name = str(channel_id)
+        server = self._servers.get(channel_id.server)
+        if server is None:
+            row = self.store.append(
+                None, (str(channel_id.server), Pango.Weight.BOLD, None)
+            )
+            server = self._servers[channel_id.server] = (row, [])
+        server_row, keys = server
+        position = bisect.bisect(keys, channel_id.key)
+        keys.insert(position, channel_id.key)
+        self._rows[channel_id] = self.store.insert(
+            server_row, position, self._row(page, name)
+        )
+        self.tree_view.expand_row(self.store.get_path(server_row), False)
+        self._pages[channel_id] = page
+        # "bu" should find "#butter-chat" as if it started with it
+        self.index.add(channel_id, page.model.channel.lstrip("#&"))
+        page.model.connect(self.on_model_changed)
+
+    def remove_channel(self, page):
+        channel_id = page.model.id
+        row = self._rows.pop(channel_id, None)
+        if row is None:
+            return
+        self.store.remove(row)
+        server_row, keys = self._servers[channel_id.server]
+        keys.remove(channel_id.key)
+        if not keys:
+            self.store.remove(server_row)
+            del self._servers[channel_id.server]
+        del self._pages[channel_id]
+        self.index.remove(channel_id)
+        page.model.disconnect(self.on_model_changed)
+
+    def search(self, query, limit):
+        # returns [page]
+        channel_ids = self.index.search(query.lstrip("#&"), limit)
+        return [self._pages[channel_id] for channel_id in channel_ids]
+
+    def select(self, page):
+        row = self._rows.get(page.model.id)
+        if row is not None:
+            self.tree_view.get_selection().select_iter(row)
+            self.tree_view.scroll_to_cell(self.store.get_path(row), None, False, 0, 0)
+
+    def on_selection_changed(self, selection):
+        store, row = selection.get_selected()
+        if row is not None and store[row][2]:
+            self.stack.set_visible_child_name(store[row][2])
+
+    def on_model_changed(self, model, change):
+        if change == UNREAD and model.id in self._rows:
+            title, weight, _ = self._row(self._pages[model.id], None)
+            self.store.set(self._rows[model.id], (0, 1), (title, weight))
+
+
+class QuickSwitcher(Gtk.Window):
+    # ctrl+k: type part of a channel's name, enter switches to it
+    MAX_RESULTS = 10
+
+    def __init__(self, parent, channel_list):
+        Gtk.Window.__init__(self, title="Switch to channel")
+        self.set_transient_for(parent)
+        self.set_modal(True)
+        self.set_decorated(False)
+        self.set_position(Gtk.WindowPosition.CENTER_ON_PARENT)
+        self.set_default_size(400, -1)
+        add_css_class(self, "quick-switcher")
+        self.channel_list = channel_list
+
+        vbox = Gtk.VBox()
+        self.add(vbox)
+
+        self.entry = Gtk.SearchEntry()
+        # "changed" instead of "search-changed", which waits for more typing
+        self.entry.connect("changed", self.on_changed)
+        self.entry.connect("activate", self.on_activate)
+        self.entry.connect("key-press-event", self.on_key_press)
+        vbox.pack_start(self.entry, False, False, 0)
+
+        self.results = Gtk.ListBox()
+        self.results.connect("row-activated", self.on_row_activated)
+        vbox.pack_start(self.results, True, True, 0)
+
+        self.connect("focus-out-event", self.on_focus_out)
+        self.on_changed(self.entry)
+
+    def on_changed(self, entry):
+        for row in self.results.get_children():
+            row.destroy()
+        for page in self.channel_list.search(entry.get_text(), self.MAX_RESULTS):
+            label = Gtk.Label(label=f"{page.title}   {page.model.id.server}")
+            label.set_xalign(0)
+            row = Gtk.ListBoxRow()
+            row.add(label)
+            row.stack_name = str(page.model.id)
+            self.results.add(row)
+        self.results.show_all()
+        self.results.select_row(self.results.get_row_at_index(0))
+
+    def on_key_press(self, entry, event):
+        if event.keyval == Gdk.KEY_Escape:
+            self.destroy()
+            return True
+        if event.keyval in (Gdk.KEY_Up, Gdk.KEY_Down):
+            row = self.results.get_selected_row()
+            if row is not None:
+                step = 1 if event.keyval == Gdk.KEY_Down else -1
+                row = self.results.get_row_at_index(row.get_index() + step)
+                if row is not None:
+                    self.results.select_row(row)
+            return True
+        return False
+
+    def on_activate(self, entry):
+        row = self.results.get_selected_row()
+        if row is not None:
+            self.on_row_activated(self.results, row)
+
+    def on_row_activated(self, results, row):
+        self.channel_list.stack.set_visible_child_name(row.stack_name)
+        self.destroy()
+
+    def on_focus_out(self, widget, event):
+        self.destroy()
+        return False
 
 
 class ChannelStack(Gtk.Stack):
@@ -65,15 +222,18 @@ class ChannelStack(Gtk.Stack):
 
 
 class Message(Gtk.HBox):
-    def __init__(self, author, message, names):
+    def __init__(self, author, message, matcher):
         Gtk.HBox.__init__(self)
 
         add_css_class(self, "message")
 
-        profile_image = Gtk.Image.new_from_pixbuf(get_identicon(author))
-        profile_image.set_size_request(32, 32)
-        profile_image.props.valign = Gtk.Align.END
-        self.pack_start(profile_image, False, False, 0)
+        self.author = author
+        self.profile_image = Gtk.Image()
+        self.profile_image.set_size_request(32, 32)
+        self.profile_image.props.valign = Gtk.Align.END
+        self.profile_image.connect("notify::scale-factor", self.on_scale_changed)
+        self.update_identicon()
+        self.pack_start(self.profile_image, False, False, 0)
 
         vbox = Gtk.VBox()
         self.pack_start(vbox, True, True, 0)
@@ -89,25 +249,41 @@ class Message(Gtk.HBox):
         vbox.pack_start(author_label, False, False, 0)
 
         message_label = Gtk.Label()
-        message_label.set_markup(
-            markup_urls(message, lambda text: markup_names(text, names))
-        )
+        message_label.set_markup(markup(message, matcher))
         message_label.set_xalign(0)
         message_label.set_line_wrap(True)
         message_label.set_selectable(True)
         add_css_class(message_label, "message-label")
         vbox.pack_start(message_label, False, False, 0)
 
+    def update_identicon(self):
+        # identicons are rendered at the scale of the monitor the window is on,
+        # instead of scaling up a 32x32 one.
+        scale = self.profile_image.get_scale_factor()
+        pixbuf = request_identicon(
+            self.author, functools.partial(self.on_identicon_rendered, scale), scale
+        )
+        self.set_identicon(pixbuf, scale)
+
+    def set_identicon(self, pixbuf, scale):
+        surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, scale, None)
+        self.profile_image.set_from_surface(surface)
+
+    def on_identicon_rendered(self, scale, pixbuf):
+        if scale == self.profile_image.get_scale_factor():
+            self.set_identicon(pixbuf, scale)
+
+    def on_scale_changed(self, widget, param):
+        self.update_identicon()
+
 
 class Action(Gtk.HBox):
-    def __init__(self, author, message, names):
+    def __init__(self, author, message, matcher):
         Gtk.HBox.__init__(self)
         add_css_class(self, "action")
 
         message_label = Gtk.Label()
-        message_label.set_markup(
-            markup_urls(author + " " + message, lambda text: markup_names(text, names))
-        )
+        message_label.set_markup(markup(author + " " + message, matcher))
         message_label.set_xalign(0)
         message_label.set_line_wrap(True)
         message_label.set_selectable(True)
@@ -116,7 +292,7 @@ class Action(Gtk.HBox):
 
 
 class Notice(Gtk.HBox):
-    def __init__(self, author, message, names, error=False):
+    def __init__(self, author, message, matcher, error=False):
         Gtk.HBox.__init__(self)
         add_css_class(self, "notice")
         if error:
@@ -126,9 +302,7 @@ class Notice(Gtk.HBox):
             message = author + ": " + message
 
         message_label = Gtk.Label()
-        message_label.set_markup(
-            markup_urls(message, lambda text: markup_names(text, names))
-        )
+        message_label.set_markup(markup(message, matcher))
         message_label.set_xalign(0)
         message_label.set_line_wrap(True)
         message_label.set_selectable(True)
@@ -136,30 +310,228 @@ class Notice(Gtk.HBox):
         self.pack_start(message_label, False, False, 0)
 
 
-class MessageList(Gtk.VBox):
-    def add_message(self, author, message, names):
-        message = Message(author, message, names)
-        self.pack_start(message, False, False, 0)
-        message.show_all()
-
-    def add_action(self, author, message, names):
-        message = Action(author, message, names)
-        self.pack_start(message, False, False, 0)
-        message.show_all()
-
-    def add_notice(self, author, message, names):
-        message = Notice(author, message, names)
-        self.pack_start(message, False, False, 0)
-        message.show_all()
-
-    def add_error(self, message, names):
-        message = Notice(None, message, names, error=True)
-        self.pack_start(message, False, False, 0)
-        message.show_all()
+class OlderMessages(Gtk.HBox):
+    def __init__(self, scrollback):
+        Gtk.HBox.__init__(self)
+        add_css_class(self, "older-messages")
+        self.scrollback = scrollback
+
+        self.label = Gtk.Label()
+        self.label.set_xalign(0)
+        self.pack_start(self.label, True, True, 0)
+
+        self.button = Gtk.Button(label="Load older messages")
+        self.button.connect("clicked", self.on_load_clicked)
+        self.pack_start(self.button, False, False, 0)
+
+    def update(self):
+        if self.scrollback.evicted:
+            self.label.set_text(
+                f"{self.scrollback.evicted} older lines are no longer in memory."
+            )
+        else:
+            self.label.set_text("")
+        self.button.set_visible(self.scrollback.can_load_older)
+
+    def on_load_clicked(self, button):
+        self.scrollback.load_older(settings.SCROLLBACK_LOAD_OLDER_LINES)
+
+
+class MessageList(Gtk.ScrolledWindow):
+    # only the rows in (or close to) the viewport exist as widgets, everything
+    # else is just a line in the scrollback and an (estimated) row height.
+    OVERSCAN = 8
+    ESTIMATED_ROW_HEIGHT = 48
+
+    def __init__(self, scrollback, matcher):
+        Gtk.ScrolledWindow.__init__(self)
+        self.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        self.scrollback = scrollback
+        self.matcher = matcher
+
+        self.layout = Gtk.Layout()
+        self.add(self.layout)
+
+        self.older_messages = OlderMessages(scrollback)
+        self.older_messages.show_all()
+        self.older_messages.set_no_show_all(True)
+        self.older_messages.hide()
+        self.layout.put(self.older_messages, 0, 0)
+
+        self._start = scrollback.start
+        self._heights = []
+        self._header_height = 0
+        self._offsets = [0]
+        self._offsets_dirty = False
+        self._rows = {}
+        self._width = 0
+        self._width_changed = False
+        self._at_bottom = True
+        self._update_queued = False
+
+        self.layout.connect("size-allocate", self.on_size_allocate)
+        self.get_vadjustment().connect("value-changed", self.on_scrolled)
+        scrollback.connect(self.on_scrollback_changed)
+        self.connect("destroy", self.on_destroy)
+
+    def create_row(self, line):
+        if line.kind == MESSAGE:
+            return Message(line.author, line.text, self.matcher)
+        if line.kind == ACTION:
+            return Action(line.author, line.text, self.matcher)
+        if line.kind == NOTICE:
+            return Notice(line.author, line.text, self.matcher)
+        return Notice(None, line.text, self.matcher, error=True)
+
+    def queue_update(self):
+        if not self._update_queued:
+            self._update_queued = True
+            GLib.idle_add(self.update, priority=GLib.PRIORITY_HIGH_IDLE)
+
+    def on_scrollback_changed(self, scrollback):
+        self.queue_update()
+
+    def on_destroy(self, widget):
+        self.scrollback.disconnect(self.on_scrollback_changed)
+
+    def on_size_allocate(self, widget, allocation):
+        if allocation.width != self._width:
+            self._width = allocation.width
+            self._width_changed = True
+            self.queue_update()
+
+    def on_scrolled(self, adjustment):
+        bottom = adjustment.get_upper() - adjustment.get_page_size()
+        self._at_bottom = adjustment.get_value() >= bottom - 1
+        if (
+            adjustment.get_value() <= 0
+            and not self._at_bottom
+            and self.scrollback.can_load_older
+        ):
+            self.scrollback.load_older(settings.SCROLLBACK_LOAD_OLDER_LINES)
+        self.queue_update()
+
+    def _sync_rows(self):
+        start = self.scrollback.start
+        if start > self._start:
+            del self._heights[: start - self._start]
+            for index in [i for i in self._rows if i < start]:
+                self._rows.pop(index).destroy()
+        elif start < self._start:
+            self._heights[:0] = [self.ESTIMATED_ROW_HEIGHT] * (self._start - start)
+        if start != self._start:
+            self._start = start
+            self._offsets_dirty = True
+
+        missing = self.scrollback.end - self._start - len(self._heights)
+        if missing > 0:
+            self._heights.extend([self.ESTIMATED_ROW_HEIGHT] * missing)
+            self._offsets_dirty = True
+
+        self.older_messages.update()
+        show_header = bool(self.scrollback.evicted or self.scrollback.can_load_older)
+        self.older_messages.set_visible(show_header)
+        header_height = 0
+        if show_header:
+            self.older_messages.set_size_request(self._width, -1)
+            header_height = self.older_messages.get_preferred_height_for_width(
+                self._width
+            )[1]
+        if header_height != self._header_height:
+            self._header_height = header_height
+            self._offsets_dirty = True
+
+    def _rebuild_offsets(self):
+        self._offsets = list(
+            itertools.accumulate(self._heights, initial=self._header_height)
+        )
+        self._offsets_dirty = False
+        self.layout.set_size(self._width, self._offsets[-1])
+
+    def _measure(self, index, row):
+        height = row.get_preferred_height_for_width(self._width)[1]
+        if height != self._heights[index - self._start]:
+            self._heights[index - self._start] = height
+            self._offsets_dirty = True
+
+    def _row_at(self, y):
+        index = bisect.bisect_right(self._offsets, y) - 1
+        return max(0, min(index, len(self._heights) - 1))
+
+    def _top(self, anchor, page_size):
+        bottom = max(0, self._offsets[-1] - page_size)
+        if self._at_bottom:
+            return bottom
+        if anchor is None:
+            return min(self.get_vadjustment().get_value(), bottom)
+        index, delta = anchor
+        if index < self._start:
+            return 0
+        return min(self._offsets[index - self._start] + delta, bottom)
+
+    def update(self):
+        self._update_queued = False
+        if self._width <= 1:
+            return False
+
+        adjustment = self.get_vadjustment()
+        page_size = adjustment.get_page_size()
+        # remember which line is at the top of the viewport, so the view
+        # doesn't jump when lines are evicted or loaded above it, or when rows
+        # above it turn out to have a different height than estimated.
+        anchor = None
+        if not self._at_bottom and self._heights:
+            value = adjustment.get_value()
+            row = self._row_at(value)
+            anchor = (self._start + row, value - self._offsets[row])
+
+        self._sync_rows()
+        if self._width_changed:
+            self._width_changed = False
+            for index, row in self._rows.items():
+                row.set_size_request(self._width, -1)
+                self._measure(index, row)
+        if self._offsets_dirty:
+            self._rebuild_offsets()
+
+        if self._at_bottom:
+            # lines loaded from history are let go again once the user is
+            # back at the bottom.
+            self.scrollback.trim()
+            self._sync_rows()
+            if self._offsets_dirty:
+                self._rebuild_offsets()
+
+        top = self._top(anchor, page_size)
+        count = len(self._heights)
+        first = max(0, self._row_at(top) - self.OVERSCAN) + self._start
+        last = bisect.bisect_left(self._offsets, top + page_size) + self.OVERSCAN
+        last = min(count, last) + self._start
+
+        for index in [i for i in self._rows if not first <= i < last]:
+            self._rows.pop(index).destroy()
+
+        for index in range(first, last):
+            if index not in self._rows:
+                row = self.create_row(self.scrollback.get(index))
+                row.set_size_request(self._width, -1)
+                row.show_all()
+                self.layout.put(row, 0, 0)
+                self._rows[index] = row
+                self._measure(index, row)
+
+        if self._offsets_dirty:
+            self._rebuild_offsets()
+            top = self._top(anchor, page_size)
+
+        for index, row in self._rows.items():
+            self.layout.move(row, 0, self._offsets[index - self._start])
+        adjustment.set_value(top)
+        return False
 
 
 class MessageEntry(Gtk.Entry):
-    def __init__(self):
+    def __init__(self, completions):
         Gtk.Entry.__init__(self)
         self.set_icon_from_icon_name(
             Gtk.EntryIconPosition.SECONDARY, "go-next-symbolic"
@@ -167,162 +539,301 @@ class MessageEntry(Gtk.Entry):
         self.set_icon_activatable(Gtk.EntryIconPosition.SECONDARY, True)
         self.set_icon_sensitive(Gtk.EntryIconPosition.SECONDARY, True)
 
-        self.completion = Gtk.EntryCompletion()
-        self.completion.set_match_func(self.match, None)
-        self.completion.connect("match-selected", self.on_match)
-        self.set_completion(self.completion)
-
-        self.list_store = Gtk.ListStore(GObject.TYPE_STRING)
-        self.completion.set_model(self.list_store)
-        self.completion.set_text_column(0)
-
-    def set_completions(self, completions):
-        self.list_store.clear()
-        for completion in completions:
-            self.list_store.append((completion,))
-
-    def match(self, completion, key, tree_iter, data):
-        model = self.completion.get_model()
-        completion_string = model[tree_iter][0]
-
-        if " " in key:
-            key = key.split(" ")[-1]
-
-        return completion_string.lower().startswith(key.lower())
-
-    def on_match(self, completion, model, tree_iter):
+        self.completions = completions
+        # pressing tab again right after completing goes to the next match:
+        # (text and cursor after completing, text before and after the
+        # completed word, the matches, index of the current one)
+        self._completing = None
+        self.connect("key-press-event", self.on_key_press)
+
+    def on_key_press(self, widget, event):
+        if event.keyval == Gdk.KEY_Tab:
+            self.complete(1)
+            return True
+        if event.keyval == Gdk.KEY_ISO_Left_Tab:
+            self.complete(-1)
+            return True
+        self._completing = None
+        return False
+
+    def complete(self, step):
         # TODO: deal with the cursor not being at the end of the line better
-
         text = self.get_text()
-        if " " in text:
-            text = text.rpartition(" ")[0] + " "
-            suffix = " "
+        position = self.get_position()
+        completing = self._completing
+        if completing is not None and completing[0] == (text, position):
+            _, before, after, matches, index = completing
+            index = (index + step) % len(matches)
         else:
-            text = ""
-            suffix = ": "
-
-        text += model[tree_iter][0] + suffix
-        self.set_text(text)
-        self.set_position(-1)
-
-        return True
+            before, after = text[:position], text[position:]
+            start = before.rfind(" ") + 1
+            matches = self.completions.complete(before[start:])
+            if not matches:
+                return
+            before = before[:start]
+            index = 0 if step > 0 else len(matches) - 1
+
+        completed = before + matches[index] + (" " if before else ": ")
+        self.set_text(completed + after)
+        self.set_position(len(completed))
+        self._completing = (
+            (completed + after, len(completed)),
+            before,
+            after,
+            matches,
+            index,
+        )
 
 
 class Channel(Gtk.VBox):
-    def __init__(self, host, port, channel):
+    # the widgets for a channel, only made while it's shown, see ChannelPage
+    def __init__(self, model):
         Gtk.VBox.__init__(self)
-        self.host = host
-        self.port = port
-        self.channel = channel
-        self.names = []
-        self._names = []
+        self.model = model
 
-        self.topic = Gtk.Label(label="No topic set.")
+        self.topic = Gtk.Label()
         self.topic.set_line_wrap(True)
         self.topic.set_justify(Gtk.Justification.LEFT)
         self.topic.set_xalign(0)
         add_css_class(self.topic, "topic")
+        self.update_topic()
         self.pack_start(self.topic, False, False, 0)
 
-        vbox = Gtk.VBox()
-        self.pack_start(vbox, True, True, 0)
+        self.message_list = MessageList(model.scrollback, model.matcher)
+        self.pack_start(self.message_list, True, True, 0)
 
-        self.message_list = MessageList()
-        vbox.pack_start(self.message_list, True, True, 0)
-
-        self.text_entry = MessageEntry()
+        self.text_entry = MessageEntry(model.completions)
         self.text_entry.connect("activate", self.send_message)
-        self.text_entry.set_completions(self.names)
         self.pack_start(self.text_entry, False, False, 0)
 
-    def send_command(self, command, args):
-        command = command.lower()
-        if command == "say":
-            protocol.send_message(self.host, self.port, self.channel, args)
-        elif command == "me":
-            if not args:
-                return
-            protocol.send_action(self.host, self.port, self.channel, args)
-        elif command == "nick":
-            if " " in args:
-                self.message_list.add_error(
-                    "Nickname cannot contain spaces", self.names
-                )
-                return
-            protocol.change_nick(args)
-        elif command == "join":
-            if " " in args:
-                self.message_list.add_error(
-                    "Channel name cannot contain spaces", self.names
-                )
-                return
-            if "," in args:
-                self.message_list.add_error(
-                    "Channel name cannot contain commas", self.names
-                )
-                return
-            if "\x07" in args:
-                self.message_list.add_error(
-                    "Channel name cannot contain bell characters", self.names
-                )
-                return
-
-            if args[0] not in "#&":
-                args = "#" + args
-
-            protocol.join_channel(self.host, self.port, args)
-        else:
-            self.message_list.add_error(f'Unknown command "{command}"', [])
-
-    def on_list_names(self, names):
-        self._names.extend(names)
+        self.warm_identicons()
+        model.connect(self.on_model_changed)
+        self.connect("destroy", self.on_destroy)
 
-    def on_end_names(self):
-        self.names = self._names
-        self.text_entry.set_completions(self.names)
-        self._names = []
+    def warm_identicons(self):
+        # at the scale the messages will ask for, or they'd all miss
+        warm_identicons(self.model.completions.by_recency(), self.get_scale_factor())
 
-    def on_message_received(self, user, message):
-        self.message_list.add_message(user, message, self.names)
+    def on_destroy(self, widget):
+        self.model.disconnect(self.on_model_changed)
 
-    def on_action_received(self, user, message):
-        self.message_list.add_action(user, message, self.names)
+    def on_model_changed(self, model, change):
+        if change == TOPIC:
+            self.update_topic()
+        elif change == MEMBERS:
+            self.warm_identicons()
 
-    def on_notice_received(self, user, message):
-        self.message_list.add_notice(user, message, self.names)
+    def update_topic(self):
+        if self.model.topic:
+            self.topic.set_markup(markup(self.model.topic, self.model.matcher))
+        else:
+            self.topic.set_text("No topic set.")
 
     def send_message(self, widget, do_command=True):
         text = widget.get_text()
         if not text:
             return
+        model = self.model
         if text[0] == "/":
             splat = text[1:].split(" ", 1)
             if len(splat) == 1:
                 splat.append("")
-            self.send_command(*splat)
+            if splat[0].lower() == "search":
+                self.get_toplevel().search(splat[1], model)
+            else:
+                model.send_command(*splat)
         else:
-            protocol.send_message(self.host, self.port, self.channel, text)
+            model.send_command("say", text)
         widget.set_text("")
 
-    def on_topic_changed(self, topic):
-        if topic:
-            self.topic.set_markup(markup_urls(topic))
+
+class SearchResultRow(Gtk.ListBoxRow):
+    def __init__(self, result):
+        Gtk.ListBoxRow.__init__(self)
+        add_css_class(self, "search-result")
+        self.result = result
+
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(result.time))
+        label = Gtk.Label()
+        label.set_markup(
+            f"<small>{escape(when)}  {escape(result.channel)}</small>\n"
+            f"<b>{escape(result.author or '')}</b> {markup(result.text or '')}"
+        )
+        label.set_xalign(0)
+        label.set_line_wrap(True)
+        self.add(label)
+
+
+class SearchPanel(Gtk.VBox):
+    # results of /search over the message log, newest first. a page is loaded
+    # at a time, the next one once the list is scrolled to the end.
+    PAGE_SIZE = 50
+
+    def __init__(self, stack):
+        Gtk.VBox.__init__(self)
+        add_css_class(self, "search-panel")
+        self.set_size_request(320, -1)
+        self.stack = stack
+        self.query = None
+        # where in:#channel is looked for, the server of the channel /search
+        # was used in, and its casemapping
+        self._server = None
+        self._fold = str.lower
+        self._last_id = None
+        self._loading = False
+        self._exhausted = True
+        # results of searches that have been replaced since are ignored
+        self._generation = 0
+
+        header = Gtk.HBox()
+        self.entry = Gtk.SearchEntry()
+        self.entry.connect("activate", self.on_activate)
+        header.pack_start(self.entry, True, True, 0)
+        close_button = Gtk.Button.new_from_icon_name(
+            "window-close-symbolic", Gtk.IconSize.BUTTON
+        )
+        close_button.set_relief(Gtk.ReliefStyle.NONE)
+        close_button.connect("clicked", self.on_close_clicked)
+        header.pack_start(close_button, False, False, 0)
+        self.pack_start(header, False, False, 0)
+
+        self.status = Gtk.Label()
+        self.status.set_xalign(0)
+        self.pack_start(self.status, False, False, 0)
+
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        scrolled_window.connect("edge-reached", self.on_edge_reached)
+        self.results = Gtk.ListBox()
+        self.results.set_selection_mode(Gtk.SelectionMode.NONE)
+        self.results.connect("row-activated", self.on_row_activated)
+        scrolled_window.add(self.results)
+        self.pack_start(scrolled_window, True, True, 0)
+
+        self.show_all()
+        self.set_no_show_all(True)
+        self.hide()
+
+    def search(self, text, server, fold):
+        self._server = server
+        self._fold = fold
+        self.entry.set_text(text)
+        self.show()
+        self.run(text)
+
+    def run(self, text):
+        # the message log is only imported once something is searched for
+        from .messagelog import parse_search
+
+        self._generation += 1
+        self._loading = False
+        self._last_id = None
+        for row in self.results.get_children():
+            row.destroy()
+        try:
+            query = parse_search(text)
+        except ValueError as e:
+            self.query = None
+            self.status.set_text(str(e))
+            return
+        if query.channel is not None and self._server is not None:
+            query = query._replace(
+                server=str(self._server), channel=self._fold(query.channel)
+            )
+        self.query = query
+        self._exhausted = False
+        self.status.set_text("Searching…")
+        self.load_more()
+
+    def load_more(self):
+        if self._loading or self._exhausted:
+            return
+        if protocol.message_log is None:
+            self.status.set_text("There is no message log to search, see MESSAGE_LOG")
+            return
+        self._loading = True
+        future = protocol.message_log.search(self.query, self._last_id, self.PAGE_SIZE)
+        future.add_done_callback(
+            functools.partial(GLib.idle_add, self.on_results, self._generation)
+        )
+
+    def on_results(self, generation, future):
+        if generation != self._generation:
+            return False
+        self._loading = False
+        try:
+            results = future.result()
+        except ValueError as e:
+            self._exhausted = True
+            self.status.set_text(str(e))
+            return False
+        for result in results:
+            row = SearchResultRow(result)
+            row.show_all()
+            self.results.add(row)
+        if results:
+            self._last_id = results[-1].id
+        self._exhausted = len(results) < self.PAGE_SIZE
+        count = len(self.results.get_children())
+        if not count:
+            self.status.set_text("No results")
         else:
-            self.topic.set_text("No topic set.")
+            more = "" if self._exhausted else "+"
+            self.status.set_text(f"{count}{more} results")
+        return False
+
+    def on_activate(self, entry):
+        self.run(entry.get_text())
+
+    def on_close_clicked(self, button):
+        self.hide()
+
+    def on_edge_reached(self, scrolled_window, position):
+        if position == Gtk.PositionType.BOTTOM:
+            self.load_more()
+
+    def on_row_activated(self, results, row):
+        # the channel's name in the stack, if it's still open
+        self.stack.set_visible_child_name(f"{row.result.server}/{row.result.channel}")
+
+
+class ChannelPage(Gtk.VBox):
+    # what the stack has for every channel. with hundreds of channels joined,
+    # most of them are never looked at, so the widgets are only made when the
+    # channel is first shown and let go again when it hasn't been shown for
+    # CHANNEL_VIEW_RELEASE_AFTER seconds. until then the channel is just its
+    # model, with unread lines counted in the channel list.
+    def __init__(self, model):
+        Gtk.VBox.__init__(self)
+        self.model = model
+        self.view = None
+        self.hidden_at = time.monotonic()
+        self.connect("destroy", self.on_destroy)
+
+    @property
+    def title(self):
+        if self.model.unread:
+            return f"{self.model.channel} ({self.model.unread})"
+        return self.model.channel
 
-    def on_user_joined(self, user):
-        self.names.append(user)
-        self.text_entry.set_completions(self.names)
+    def on_destroy(self, widget):
+        self.model.close()
 
-    def on_user_left(self, user):
-        self.names.remove(user)
-        self.text_entry.set_completions(self.names)
+    def show_view(self):
+        self.model.set_visible(True)
+        if self.view is None:
+            self.view = Channel(self.model)
+            self.view.show_all()
+            self.pack_start(self.view, True, True, 0)
 
-    def on_user_renamed(self, old_user, new_user):
-        if old_user in self.names:
-            self.names.remove(old_user)
-            self.names.append(new_user)
-        self.text_entry.set_completions(self.names)
+    def hide_view(self):
+        self.model.set_visible(False)
+        self.hidden_at = time.monotonic()
+
+    def release_view(self):
+        if self.view is not None:
+            self.view.destroy()
+            self.view = None
 
 
 class ChatWindow(Gtk.Window):
@@ -346,81 +857,198 @@ class ChatWindow(Gtk.Window):
         hbox = Gtk.HBox()
         self.add(hbox)
 
-        channel_list = ChannelList()
-        hbox.pack_start(channel_list, False, False, 0)
-
         self.channel_stack = ChannelStack()
+        self.channel_list = ChannelList(self.channel_stack)
+        hbox.pack_start(self.channel_list, False, False, 0)
         hbox.pack_start(self.channel_stack, True, True, 10)
+        self.search_panel = SearchPanel(self.channel_stack)
+        hbox.pack_start(self.search_panel, False, False, 0)
+        self.connect("key-press-event", self.on_key_press)
+
+        self._visible_page = None
+        self.channel_stack.connect(
+            "notify::visible-child", self.on_visible_channel_changed
+        )
+
+        # channel widgets subscribe to the events for their own channel here,
+        # which is only published to once the events are taken off the queue
+        self.bus = EventBus()
+        self.bus.subscribe(SignedOn, self.on_signed_on)
+        self.bus.subscribe(ChannelJoined, self.on_channel_joined)
+        self.bus.subscribe(MessageReceived, self.on_message_received)
+        self.bus.subscribe(ActionReceived, self.on_message_received)
+        self.bus.subscribe(NoticeReceived, self.on_message_received)
+        self.bus.subscribe(Batch, self.on_batch)
+        # ChannelPages, by ChannelId
+        self.channels = {}
+        if settings.CHANNEL_VIEW_RELEASE_AFTER is not None:
+            GLib.timeout_add_seconds(60, self.on_release_timeout)
+
+        self.events = EventQueue(self.deliver_events)
+        self._tick_id = None
+        self._last_tick = 0.0
+        self._drain_timeout_id = None
+        for event_type in EVENT_TYPES:
+            protocol.bus.subscribe(event_type, self.queue_event)
+
+        self.connect("delete-event", self.on_delete)
+        snapshot = None
+        if settings.SESSION_SNAPSHOT is not None:
+            snapshot = session.load(settings.SESSION_SNAPSHOT)
+        if snapshot is not None:
+            self.restore_session(snapshot)
+        else:
+            protocol.connect(generate_name(), "irc.libera.chat")
+
+    def queue_event(self, event):
+        # events are handled once per frame, so a flood of messages doesn't
+        # cause a relayout for every single line.
+        self.events.push(event)
+        if self._tick_id is None and self.get_mapped():
+            self._tick_id = self.add_tick_callback(self.on_tick)
+        if self._drain_timeout_id is None:
+            self._drain_timeout_id = GLib.timeout_add(250, self.on_drain_timeout)
+
+    def deliver_events(self, events):
+        with batched_changes():
+            for event in events:
+                self.bus.publish(event)
+
+    def on_tick(self, widget, frame_clock):
+        self._last_tick = time.monotonic()
+        if self.events.drain():
+            return GLib.SOURCE_CONTINUE
+        self._tick_id = None
+        return GLib.SOURCE_REMOVE
+
+    def on_drain_timeout(self):
+        # the frame clock doesn't run while the window is hidden, and may not
+        # while it's minimized either, so this drains whenever there hasn't
+        # been a tick in a while
+        if time.monotonic() - self._last_tick > 0.25:
+            # nothing's being drawn meanwhile, so this can take more than a
+            # frame's worth at a time, enough to keep up with a flood
+            deadline = time.monotonic() + 0.1
+            while self.events.drain() and time.monotonic() < deadline:
+                pass
+        if self.events:
+            # e.g. the window was mapped after these were queued
+            if self._tick_id is None and self.get_mapped():
+                self._tick_id = self.add_tick_callback(self.on_tick)
+            return GLib.SOURCE_CONTINUE
+        self._drain_timeout_id = None
+        return GLib.SOURCE_REMOVE
+
+    def get_channel_page(self, event, create=False):
+        channel_id = ChannelId(event.server, event.key)
+        page = self.channels.get(channel_id)
+        if create and page is None:
+            page = self.add_channel_page(channel_id, event.channel)
+        return page
+
+    def add_channel_page(self, channel_id, channel, state=None):
+        # state is the channel's part of a session snapshot
+        model = ChannelModel(channel_id, channel, self.bus)
+        if state is not None:
+            model.restore(state)
+        page = ChannelPage(model)
+        page.connect("destroy", self.on_channel_destroyed)
+        page.show()
+        self.channel_stack.add_named(page, str(channel_id))
+        self.channel_list.add_channel(page)
+        self.channels[channel_id] = page
+        return page
+
+    def restore_session(self, snapshot):
+        # shows everything like it was when the client was closed, the servers
+        # catch it up once they're connected
+        for state in snapshot["channels"]:
+            server_id = ServerId(state["host"], state["port"])
+            channel_id = ChannelId(server_id, state["key"])
+            self.add_channel_page(channel_id, state["channel"], state)
+        if snapshot["visible"] is not None:
+            self.channel_stack.set_visible_child_name(snapshot["visible"])
+        for server in snapshot["servers"]:
+            protocol.connect(
+                server["nickname"], server["host"], server["port"], server["channels"]
+            )
+
+    def save_session(self):
+        snapshot = {
+            "servers": protocol.snapshot(),
+            "channels": [
+                page.model.snapshot(settings.SESSION_SNAPSHOT_LINES)
+                for page in self.channels.values()
+            ],
+            "visible": self.channel_stack.get_visible_child_name(),
+        }
+        try:
+            session.save(settings.SESSION_SNAPSHOT, snapshot)
+        except OSError as e:
+            print("could not save the session:", e)
+
+    def on_delete(self, widget, event):
+        # the channels are still all there, unlike once the window's destroyed
+        if settings.SESSION_SNAPSHOT is not None:
+            self.save_session()
+        return False
+
+    def on_channel_destroyed(self, page):
+        self.channels.pop(page.model.id, None)
+        self.channel_list.remove_channel(page)
+
+    def search(self, text, model):
+        # in:#channel means a channel on the same server as model
+        self.search_panel.search(text, model.id.server, model.matcher.normalize)
+
+    def on_key_press(self, widget, event):
+        control = event.state & Gdk.ModifierType.CONTROL_MASK
+        if control and event.keyval in (Gdk.KEY_k, Gdk.KEY_K):
+            QuickSwitcher(self, self.channel_list).show_all()
+            return True
+        return False
+
+    def on_visible_channel_changed(self, stack, param):
+        if self._visible_page is not None:
+            self._visible_page.hide_view()
+        self._visible_page = stack.get_visible_child()
+        if self._visible_page is not None:
+            self._visible_page.show_view()
+            self.channel_list.select(self._visible_page)
+
+    def on_release_timeout(self):
+        now = time.monotonic()
+        for page in self.channels.values():
+            if (
+                page is not self._visible_page
+                and now - page.hidden_at > settings.CHANNEL_VIEW_RELEASE_AFTER
+            ):
+                page.release_view()
+        return GLib.SOURCE_CONTINUE
+
+    def on_signed_on(self, event):
+        for channel_id, page in self.channels.items():
+            if channel_id.server == event.server:
+                page.model.update_server()
+
+    def on_channel_joined(self, event):
+        # rejoining after reconnecting doesn't switch channels
+        page = self.get_channel_page(event)
+        if page is None:
+            self.channel_stack.set_visible_child(self.get_channel_page(event, True))
+        else:
+            page.model.update_server()
+
+    def on_batch(self, event):
+        # the events in a batch are a single event on the queue, so they're
+        # handled in the same frame and scrollbacks are only notified once.
+        # batches about a single channel (history) are up to that channel.
+        if event.channel is not None:
+            return
+        for batched_event in event.events:
+            self.bus.publish(batched_event)
 
-        channel_list.set_stack(self.channel_stack)
-
-        protocol.register_handler("channel_joined", self.on_channel_joined)
-        protocol.register_handler("message_received", self.on_message_received)
-        protocol.register_handler("action_received", self.on_action_received)
-        protocol.register_handler("notice_received", self.on_notice_received)
-        protocol.register_handler("topic_changed", self.on_topic_changed)
-        protocol.register_handler("user_joined", self.on_user_joined)
-        protocol.register_handler("user_left", self.on_user_left)
-        protocol.register_handler("user_renamed", self.on_user_renamed)
-        protocol.register_handler("list_names", self.on_list_names)
-        protocol.register_handler("end_names", self.on_end_names)
-
-        protocol.connect(generate_name(), "irc.libera.chat")
-
-    def get_channel_widget(self, channel, host, port, create=False):
-        channel_id = f"{host}:{port}/{channel}"
-        channel_widget = self.channel_stack.get_child_by_name(channel_id)
-        if create and not channel_widget:
-            channel_widget = Channel(host, port, channel)
-            channel_widget.show_all()
-            self.channel_stack.add_titled(channel_widget, channel_id, channel)
-        return channel_widget
-
-    def on_list_names(self, *, channel, names, host, port):
-        channel_widget = self.get_channel_widget(channel, host, port)
-        if channel_widget:
-            channel_widget.on_list_names(names)
-
-    def on_end_names(self, *, channel, host, port):
-        channel_widget = self.get_channel_widget(channel, host, port)
-        if channel_widget:
-            channel_widget.on_end_names()
-
-    def on_channel_joined(self, *, channel, host, port):
-        channel_id = f"{host}:{port}/{channel}"
-        channel_widget = Channel(host, port, channel)
-        channel_widget.show_all()
-        self.channel_stack.add_titled(channel_widget, channel_id, channel)
-        self.channel_stack.set_visible_child(channel_widget)
-
-    def on_message_received(self, *, user, message, channel, host, port):
-        channel_widget = self.get_channel_widget(channel, host, port, True)
-        channel_widget.on_message_received(user, message)
-
-    def on_action_received(self, *, user, message, channel, host, port):
-        channel_widget = self.get_channel_widget(channel, host, port, True)
-        channel_widget.on_action_received(user, message)
-
-    def on_notice_received(self, *, user, message, channel, host, port):
-        channel_widget = self.get_channel_widget(channel, host, port, True)
-        channel_widget.on_notice_received(user, message)
-
-    def on_topic_changed(self, *, topic, channel, host, port):
-        channel_widget = self.get_channel_widget(channel, host, port)
-        if channel_widget:
-            channel_widget.on_topic_changed(topic)
-
-    def on_user_joined(self, *, user, channel, host, port):
-        channel_widget = self.get_channel_widget(channel, host, port)
-        if channel_widget:
-            channel_widget.on_user_joined(user)
-
-    def on_user_left(self, *, user, channel, host, port):
-        channel_widget = self.get_channel_widget(channel, host, port)
-        if channel_widget:
-            channel_widget.on_user_left(user)
-
-    def on_user_renamed(self, *, old_user, new_user, host, port):
-        for channel_widget in self.channel_stack.get_children():
-            if channel_widget.host == host and channel_widget.port == port:
-                channel_widget.on_user_renamed(old_user, new_user)
+    def on_message_received(self, event):
+        # private messages open a channel for the other side, the channel
+        # itself gets the message from its own subscription
+        self.get_channel_page(event, True)
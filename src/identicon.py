@@ -1,22 +1,35 @@
 # -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import functools
+import itertools
+import os.path
 import zlib
 
 from gi.repository import GdkPixbuf
 from gi.repository import GLib
-from PIL import Image
-from PIL import ImageDraw
 
 from . import colors
+from . import settings
+from .identicon_atlas import Atlas
 
+LAYERS = ("bottom", "face", "side", "top")
+VARIANTS = 21
+VARIANT_PAIRS = VARIANTS * VARIANTS
+SIZE = 32
 
-def name_to_color_class(name):
-    hue = zlib.crc32(name.encode("utf-8")) * 90 // 0xFFFFFFFF * 4
-    return f"label_color_h{hue:02d}"
+# PIL and numpy take longer to import than the rest of the client together, so
+# they're only imported once an identicon is actually rendered. with an atlas
+# that only ever happens on the worker threads.
 
 
-def name_to_color(name):
-    hue = zlib.crc32(name.encode("utf-8")) * 90 // 0xFFFFFFFF * 4
-    return colors.name[hue]
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
 
 
 def image_to_pixbuf(img):
@@ -27,41 +40,392 @@ def image_to_pixbuf(img):
     )
 
 
-# TODO: limit identicon cache size
-_identicon_cache = {}
+def _load_layer(layer, variant, scale):
+    from PIL import Image
 
+    path = f"identicon/{layer}/{layer}_{variant:02d}"
+    if scale == 1:
+        return Image.open(path + ".png").convert("RGBA")
 
-def get_identicon(name):
-    number = zlib.crc32(name.encode("utf-8")) * (194481) // 0xFFFFFFFF
-    if number in _identicon_cache:
-        return _identicon_cache[number]
+    size = SIZE * scale
+    if os.path.exists(path + ".svg"):
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(path + ".svg", size, size)
+        return Image.frombytes(
+            "RGBA",
+            (size, size),
+            pixbuf.get_pixels(),
+            "raw",
+            "RGBA",
+            pixbuf.get_rowstride(),
+        )
+    # not every layer has an svg version
+    return Image.open(path + ".png").convert("RGBA").resize((size, size), Image.LANCZOS)
 
-    rest = number
-    bottom_number = rest % 21 + 1
-    number = rest // 21
-    face_number = rest % 21 + 1
-    number = rest // 21
-    side_number = rest % 21 + 1
-    number = rest // 21
-    top_number = rest % 21 + 1
 
-    result = Image.new("RGBA", (32, 32))
-    draw = ImageDraw.Draw(result)
-    draw.ellipse((8, 8, 24, 24), fill=name_to_color(name))
+@functools.lru_cache(maxsize=None)
+def load_layers(scale=1):
+    # all 84 layer images at a scale, decoded once:
+    # load_layers(scale)[layer][variant]
+    return tuple(
+        tuple(_load_layer(layer, variant, scale) for variant in range(1, VARIANTS + 1))
+        for layer in LAYERS
+    )
+
+
+def identicon_key(name):
+    # everything an identicon depends on: the layer combination and the hue
+    # of the background circle.
+    crc = zlib.crc32(name.encode("utf-8"))
+    number = crc * VARIANTS ** len(LAYERS) // 0x100000000
+    hue = crc * 90 // 0xFFFFFFFF * 4
+    return number, hue
+
+
+def layer_variants(number):
+    variants = []
+    for _ in LAYERS:
+        number, variant = divmod(number, VARIANTS)
+        variants.append(variant)
+    return variants
+
+
+class IdenticonCache:
+    # keys are (number, hue, scale). the size is counted in 32x32 identicons,
+    # so a scale 2 identicon takes up four times as much of it.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        pixbuf = self._items.get(key)
+        if pixbuf is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return pixbuf
+
+    def put(self, key, pixbuf):
+        if key not in self._items:
+            self.size += key[2] * key[2]
+        self._items[key] = pixbuf
+        self._items.move_to_end(key)
+        self._trim()
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        self._trim()
+
+    def _trim(self):
+        while self.size > self.maxsize and self._items:
+            key, _ = self._items.popitem(last=False)
+            self.size -= key[2] * key[2]
+
+    def stats(self):
+        return {
+            "identicons": len(self._items),
+            "size": self.size,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+_identicon_cache = IdenticonCache(settings.IDENTICON_CACHE_SIZE)
+
+
+def identicon_cache_stats():
+    return _identicon_cache.stats()
+
+
+def set_identicon_cache_size(maxsize):
+    _identicon_cache.resize(maxsize)
+
+
+def _draw_circle(image, scale, fill):
+    from PIL import ImageDraw
+
+    ImageDraw.Draw(image).ellipse(
+        (8 * scale, 8 * scale, 24 * scale, 24 * scale), fill=fill
+    )
+
+
+def render_identicon(number, hue, scale=1):
+    from PIL import Image
+
+    result = Image.new("RGBA", (SIZE * scale, SIZE * scale))
+    _draw_circle(result, scale, colors.name[hue])
+
+    for images, variant in zip(load_layers(scale), layer_variants(number)):
+        layer = images[variant]
+        result.paste(layer, mask=layer)
+
+    return result
+
+
+def _hue_rgba(hue):
+    color = colors.name[hue]
+    return [int(color[i : i + 2], 16) for i in (1, 3, 5)] + [255]
+
+
+@functools.lru_cache(maxsize=None)
+def _layer_pairs():
+    # pasting a layer is result * (1 - alpha) + color * alpha, so two layers on
+    # top of each other collapse into a single multiply-add as well. this
+    # precomputes that for all 441 (bottom, face) and (side, top) pairs, in a
+    # (pair, channel, pixel) layout so numpy works along whole rows of pixels.
+    from PIL import Image
+
+    numpy = _numpy()
+    pixels = numpy.array(
+        [[numpy.asarray(image) for image in images] for images in load_layers()],
+        dtype=numpy.float32,
+    )
+    pixels = pixels.reshape(len(LAYERS), VARIANTS, -1, 4).transpose(0, 1, 3, 2)
+    alpha = pixels[:, :, 3:4] / 255
+    transparency = 1 - alpha
+    color = pixels * alpha
+
+    def pair(lower, upper):
+        # indexed by lower variant + upper variant * VARIANTS, like the number
+        pair_transparency = transparency[upper][:, None] * transparency[lower]
+        pair_color = transparency[upper][:, None] * color[lower] + color[upper][:, None]
+        return (
+            pair_transparency.reshape(VARIANT_PAIRS, 1, -1),
+            pair_color.reshape(VARIANT_PAIRS, 4, -1),
+        )
+
+    low_transparency, low_color = pair(0, 1)
+    high_transparency, high_color = pair(2, 3)
+
+    circle = Image.new("L", (SIZE, SIZE))
+    _draw_circle(circle, 1, 255)
+    circle = (numpy.asarray(circle).reshape(1, -1) > 0).astype(numpy.float32)
+    # the 0.5 makes the final conversion to bytes round instead of truncate
+    return low_transparency * circle, low_color, high_transparency, high_color + 0.5
+
+
+def composite_identicons(keys):
+    # renders render_identicon(*key) for all (scale 1) keys in one go. the
+    # results are within rounding (off by one at most) of what PIL produces.
+    numpy = _numpy()
+    background, low_color, high_transparency, high_color = _layer_pairs()
+    numbers = numpy.array([key[0] for key in keys], dtype=numpy.int64)
+    high, low = numpy.divmod(numbers, VARIANT_PAIRS)
+    hues = numpy.array([_hue_rgba(key[1]) for key in keys], dtype=numpy.float32)
+
+    result = hues[:, :, None] * background[low]
+    result += low_color[low]
+    result *= high_transparency[high]
+    result += high_color[high]
+    return result.astype(numpy.uint8).transpose(0, 2, 1).reshape(-1, SIZE, SIZE, 4)
+
 
-    bottom = Image.open(f"identicon/bottom/bottom_{bottom_number:02d}.png").convert(
-        "RGBA"
+def pixels_to_pixbuf(pixels, size):
+    return GdkPixbuf.Pixbuf.new_from_bytes(
+        GLib.Bytes(pixels), GdkPixbuf.Colorspace.RGB, True, 8, size, size, size * 4
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _atlas():
+    try:
+        return Atlas(settings.IDENTICON_ATLAS)
+    except (OSError, ValueError):
+        return None
+
+
+def _atlas_for(scale):
+    atlas = _atlas()
+    if atlas is None or atlas.size != SIZE * scale:
+        return None
+    return atlas
+
+
+# masks of the background circle by scale, for placeholders when there's no
+# atlas to take them from. they're drawn on a worker thread, so showing the
+# first messages doesn't import PIL on the main thread. None while drawing.
+_circles = {}
+
+
+def _draw_circle_mask(scale):
+    from PIL import Image
+
+    mask = Image.new("L", (SIZE * scale, SIZE * scale))
+    _draw_circle(mask, scale, 255)
+    return mask.tobytes()
+
+
+def _on_circle_drawn(scale, future):
+    try:
+        _circles[scale] = future.result()
+    except Exception as e:
+        print("could not draw the identicon background:", e)
+        del _circles[scale]
+    return False
+
+
+def _circle_mask(scale):
+    atlas = _atlas_for(scale)
+    if atlas is not None:
+        return atlas.circle
+    if scale not in _circles:
+        _circles[scale] = None
+        future = _executor().submit(_draw_circle_mask, scale)
+        future.add_done_callback(
+            functools.partial(GLib.idle_add, _on_circle_drawn, scale)
+        )
+    return _circles[scale]
+
+
+@functools.lru_cache(maxsize=None)
+def _filled_circle(hue, scale):
+    color = bytes(_hue_rgba(hue))
+    transparent = bytes(4)
+    pixels = b"".join(color if m else transparent for m in _circle_mask(scale))
+    return pixels_to_pixbuf(pixels, SIZE * scale)
+
+
+@functools.lru_cache(maxsize=None)
+def _transparent(scale):
+    return pixels_to_pixbuf(bytes(4 * SIZE * SIZE * scale * scale), SIZE * scale)
+
+
+def placeholder_identicon(hue, scale=1):
+    if _circle_mask(scale) is None:
+        # only until the circle is drawn, and the identicon itself will be
+        # there soon after anyway
+        return _transparent(scale)
+    return _filled_circle(hue, scale)
+
+
+def _atlas_identicon(key):
+    number, hue, scale = key
+    atlas = _atlas_for(scale)
+    if atlas is None:
+        return None
+    pixels = atlas.get(number)
+    if pixels is None:
+        return None
+    pixbuf = placeholder_identicon(hue, scale).copy()
+    pixels_to_pixbuf(pixels, atlas.size).composite(
+        pixbuf,
+        0,
+        0,
+        atlas.size,
+        atlas.size,
+        0,
+        0,
+        1,
+        1,
+        GdkPixbuf.InterpType.NEAREST,
+        255,
     )
-    face = Image.open(f"identicon/face/face_{face_number:02d}.png").convert("RGBA")
-    side = Image.open(f"identicon/side/side_{side_number:02d}.png").convert("RGBA")
-    top = Image.open(f"identicon/top/top_{top_number:02d}.png").convert("RGBA")
+    return pixbuf
 
-    result.paste(bottom, mask=bottom)
-    result.paste(face, mask=face)
-    result.paste(side, mask=side)
-    result.paste(top, mask=top)
 
-    pixbuf = image_to_pixbuf(result)
+def _cached_identicon(key):
+    pixbuf = _identicon_cache.get(key)
+    if pixbuf is None:
+        pixbuf = _atlas_identicon(key)
+        if pixbuf is not None:
+            _identicon_cache.put(key, pixbuf)
+    return pixbuf
+
 
-    _identicon_cache[number] = pixbuf
+def get_identicon(name, scale=1):
+    key = (*identicon_key(name), scale)
+    pixbuf = _cached_identicon(key)
+    if pixbuf is None:
+        pixbuf = image_to_pixbuf(render_identicon(*key))
+        _identicon_cache.put(key, pixbuf)
     return pixbuf
+
+
+# identicons being rendered in the background, with the callbacks waiting for
+# them. only touched from the main loop.
+_pending = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _executor():
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=settings.IDENTICON_WORKERS, thread_name_prefix="identicon"
+    )
+
+
+def _render_batch(keys):
+    # runs in a worker thread, returns the raw pixels for every key. the numpy
+    # path only does scale 1, its precomputed layers would get too big.
+    if _numpy() is None or any(key[2] != 1 for key in keys):
+        return [render_identicon(*key).tobytes() for key in keys]
+    return [pixels.tobytes() for pixels in composite_identicons(keys)]
+
+
+def _on_batch_rendered(keys, future):
+    try:
+        batch = future.result()
+    except Exception as e:
+        # the placeholders stay, and the next request for these tries again
+        print("could not render identicons:", e)
+        for key in keys:
+            del _pending[key]
+        return False
+    for key, pixels in zip(keys, batch):
+        pixbuf = pixels_to_pixbuf(pixels, SIZE * key[2])
+        _identicon_cache.put(key, pixbuf)
+        for callback in _pending.pop(key):
+            callback(pixbuf)
+    return False
+
+
+def _render_in_background(keys):
+    for key in keys:
+        _pending[key] = []
+    for i in range(0, len(keys), 256):
+        chunk = keys[i : i + 256]
+        future = _executor().submit(_render_batch, chunk)
+        future.add_done_callback(
+            functools.partial(GLib.idle_add, _on_batch_rendered, chunk)
+        )
+
+
+def request_identicon(name, callback, scale=1):
+    # returns the identicon if it's cached. otherwise it's rendered in the
+    # background and callback(pixbuf) is called from the main loop once it's
+    # done, and a placeholder is returned to show in the meantime.
+    key = (*identicon_key(name), scale)
+    pixbuf = _cached_identicon(key)
+    if pixbuf is not None:
+        return pixbuf
+    if key not in _pending:
+        _render_in_background([key])
+    _pending[key].append(callback)
+    return placeholder_identicon(key[1], scale)
+
+
+def warm_identicons(names, scale=1):
+    # renders the identicons for a list of names (e.g. a channel's members) in
+    # the background and puts them in the cache. names come in order of how
+    # likely they are to be shown, and only as many as fit in half the cache
+    # are warmed, so a big channel doesn't evict what's on screen (or its own
+    # first names).
+    limit = _identicon_cache.maxsize // (2 * scale * scale)
+    keys = dict.fromkeys(
+        (*identicon_key(name), scale) for name in itertools.islice(names, limit)
+    )
+    keys = [key for key in keys if key not in _identicon_cache and key not in _pending]
+    atlas = _atlas_for(scale)
+    if atlas is not None:
+        # these are cheap enough to make when they're needed
+        keys = [key for key in keys if key[0] not in atlas]
+    _render_in_background(keys)
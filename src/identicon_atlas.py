@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Prerenders identicon layer combinations into a single file that is mmapped at
+# runtime, so identicons can be shown without decoding any images.
+#
+#     python -m src.identicon_atlas --names nicknames.txt
+#     python -m src.identicon_atlas --all
+#
+# The file holds a header, the mask of the background circle, a sorted array
+# of layer combination numbers and then the RGBA pixels of every combination,
+# with just the layers on a transparent background.
+import array
+import bisect
+import mmap
+import os
+import os.path
+import struct
+
+MAGIC = b"BTRATLAS"
+VERSION = 1
+_header = struct.Struct("=8sIIII")
+
+
+class Atlas:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < _header.size:
+            raise ValueError(f"{path} is not an identicon atlas")
+        magic, version, self.size, count, _ = _header.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not an identicon atlas")
+
+        self._entry_size = self.size * self.size * 4
+        # e.g. a build that was interrupted
+        expected = _header.size + self.size * self.size + count * (4 + self._entry_size)
+        if len(self._mmap) != expected:
+            raise ValueError(f"{path} is truncated or damaged")
+        offset = _header.size
+        self.circle = self._mmap[offset : offset + self.size * self.size]
+        offset += self.size * self.size
+        self._numbers = memoryview(self._mmap)[offset : offset + count * 4].cast("I")
+        self._pixels = offset + count * 4
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def __contains__(self, number):
+        i = bisect.bisect_left(self._numbers, number)
+        return i < len(self._numbers) and self._numbers[i] == number
+
+    def get(self, number):
+        # returns the pixels of a layer combination, or None if it's not in
+        # the atlas
+        i = bisect.bisect_left(self._numbers, number)
+        if i == len(self._numbers) or self._numbers[i] != number:
+            return None
+        offset = self._pixels + i * self._entry_size
+        return self._mmap[offset : offset + self._entry_size]
+
+
+def build_atlas(path, numbers, scale=1):
+    from PIL import Image
+
+    from .identicon import _draw_circle
+    from .identicon import layer_variants
+    from .identicon import load_layers
+
+    numbers = array.array("I", sorted(set(numbers)))
+    layers = load_layers(scale)
+    size = layers[0][0].size[0]
+
+    circle = Image.new("L", (size, size))
+    _draw_circle(circle, scale, 255)
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(_header.pack(MAGIC, VERSION, size, len(numbers), 0))
+        f.write(circle.tobytes())
+        f.write(numbers.tobytes())
+        for number in numbers:
+            result = Image.new("RGBA", (size, size))
+            for images, variant in zip(layers, layer_variants(number)):
+                result.alpha_composite(images[variant])
+            f.write(result.tobytes())
+    os.replace(path + ".tmp", path)
+
+
+def main():
+    import argparse
+
+    from . import settings
+    from .identicon import identicon_key
+    from .identicon import LAYERS
+    from .identicon import VARIANTS
+
+    parser = argparse.ArgumentParser(description="Build the identicon atlas.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--names", help="file with the nicknames to include, one per line"
+    )
+    group.add_argument(
+        "--all",
+        action="store_true",
+        help="include every layer combination (about 800MB at scale 1)",
+    )
+    parser.add_argument(
+        "--scale", type=int, default=1, help="scale factor of the display"
+    )
+    args = parser.parse_args()
+
+    if args.all:
+        numbers = range(VARIANTS ** len(LAYERS))
+    else:
+        with open(args.names, encoding="utf-8") as f:
+            names = [line.strip() for line in f if line.strip()]
+        numbers = [identicon_key(name)[0] for name in names]
+
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    build_atlas(settings.IDENTICON_ATLAS, numbers, args.scale)
+
+
+if __name__ == "__main__":
+    main()
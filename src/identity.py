@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import collections
+import string
+import sys
+
+_upper = string.ascii_uppercase
+_lower = string.ascii_lowercase
+# how servers compare nicknames and channel names, see CASEMAPPING in
+# https://modern.ircdocs.horse/#casemapping-parameter
+_tables = {
+    "ascii": str.maketrans(_upper, _lower),
+    "rfc1459": str.maketrans(_upper + "[]\\~", _lower + "{}|^"),
+    "strict-rfc1459": str.maketrans(_upper + "[]\\", _lower + "{}|"),
+}
+
+
+class ServerId(collections.namedtuple("ServerId", ("host", "port"))):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+
+class ChannelId(collections.namedtuple("ChannelId", ("server", "key"))):
+    # key is the channel (or for private messages, nickname) folded with the
+    # server's casemapping
+    __slots__ = ()
+
+    def __str__(self):
+        return f"{self.server}/{self.key}"
+
+
+class CaseMapping:
+    # folds names the way the server compares them. folded names are interned
+    # and cached, since the same few channels and nicknames come up on every
+    # line.
+    MAX_CACHED = 16384
+
+    def __init__(self, name="rfc1459"):
+        if name not in _tables:
+            name = "rfc1459"
+        self.name = name
+        self._table = _tables[name]
+        self._folded = {}
+
+    def fold(self, name):
+        folded = self._folded.get(name)
+        if folded is None:
+            if len(self._folded) >= self.MAX_CACHED:
+                self._folded.clear()
+            folded = self._folded[name] = sys.intern(name.translate(self._table))
+        return folded
+
+    def equal(self, a, b):
+        return self.fold(a) == self.fold(b)
+
+
+default_casemapping = CaseMapping()
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import functools
+import re
+
+from .colors import name_to_color
+
+TEXT = "text"
+URL = "url"
+NICK = "nick"
+FORMAT = "format"
+
+# anything that could be (part of) a nickname. \w is wider than what RFC 2812
+# allows, but some networks allow non-ascii nicknames.
+_word_pattern = r"[\w\[\]\\`^{|}-]+"
+_url_pattern = (
+    r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+"
+)
+_format_pattern = r"\x03(?:\d{1,2}(?:,\d{1,2})?)?|[\x02\x0f\x16\x1d\x1e\x1f]"
+_token_regex = re.compile(
+    f"(?P<url>{_url_pattern})|(?P<word>{_word_pattern})|(?P<format>{_format_pattern})"
+)
+_word_regex = re.compile(_word_pattern)
+
+_escape_table = {
+    ord("&"): "&amp;",
+    ord("<"): "&lt;",
+    ord(">"): "&gt;",
+    ord('"'): "&quot;",
+    ord("'"): "&#39;",
+}
+# pango refuses markup with control characters in it
+_escape_table.update((c, None) for c in range(0x20) if chr(c) not in "\t\n")
+
+_irc_colors = (
+    "#ffffff",
+    "#000000",
+    "#00007f",
+    "#009300",
+    "#ff0000",
+    "#7f0000",
+    "#9c009c",
+    "#fc7f00",
+    "#ffff00",
+    "#00fc00",
+    "#009393",
+    "#00ffff",
+    "#0000fc",
+    "#ff00ff",
+    "#7f7f7f",
+    "#d2d2d2",
+)
+
+
+def escape(text):
+    return text.translate(_escape_table)
+
+
+class NickMatcher:
+    # finds nicknames in text by looking up every word in a dict, so the cost
+    # of matching only depends on the length of the text and not on the
+    # number of nicknames in the channel.
+    MARKUP_CACHE_SIZE = 1024
+
+    def __init__(self, nicks=(), normalize=str.lower):
+        self.normalize = normalize
+        self._nicks = {}
+        # rendered lines by text, see markup(). only good for as long as the
+        # nicknames stay the same, and gone with the channel.
+        self.markup_cache = {}
+        self.reset(nicks)
+
+    def __contains__(self, nick):
+        return self.normalize(nick) in self._nicks
+
+    def __len__(self):
+        return len(self._nicks)
+
+    def _changed(self):
+        self.markup_cache.clear()
+
+    def reset(self, nicks):
+        self._nicks = {self.normalize(nick): nick for nick in nicks}
+        self._changed()
+
+    def set_normalize(self, normalize):
+        self.normalize = normalize
+        self.reset(list(self._nicks.values()))
+
+    def add(self, nick):
+        self._nicks[self.normalize(nick)] = nick
+        self._changed()
+
+    def remove(self, nick):
+        if self._nicks.pop(self.normalize(nick), None) is not None:
+            self._changed()
+
+    def rename(self, old_nick, new_nick):
+        if self._nicks.pop(self.normalize(old_nick), None) is not None:
+            self._nicks[self.normalize(new_nick)] = new_nick
+            self._changed()
+
+    def lookup(self, word):
+        return self._nicks.get(self.normalize(word))
+
+    def match(self, word, start):
+        # returns (start, end, nick) if the word at start is a nickname
+        nick = self.lookup(word)
+        if nick is not None:
+            return start, start + len(word), nick
+        # "[nick]" and "{nick}" are valid nicknames themselves, so only strip
+        # the brackets when the whole word didn't match.
+        stripped = word.strip("[]{}")
+        if stripped and stripped != word:
+            nick = self.lookup(stripped)
+            if nick is not None:
+                start += word.index(stripped)
+                return start, start + len(stripped), nick
+        return None
+
+
+def mentions(text, nick, normalize=str.lower):
+    # whether nick is one of the words in text
+    key = normalize(nick)
+    return any(
+        len(word) == len(nick) and normalize(word) == key
+        for word in _word_regex.findall(text)
+    )
+
+
+def tokenize(text, matcher=None):
+    # splits text into (kind, text, value) tuples in a single pass, where value
+    # is the nickname for NICK tokens and the control code for FORMAT tokens.
+    tokens = []
+    offset = 0
+    for m in _token_regex.finditer(text):
+        kind = m.lastgroup
+        if kind == "word":
+            if matcher is None:
+                continue
+            match = matcher.match(m[0], m.start())
+            if match is None:
+                continue
+            start, end, nick = match
+            if start > offset:
+                tokens.append((TEXT, text[offset:start], None))
+            tokens.append((NICK, text[start:end], nick))
+            offset = end
+            continue
+        if m.start() > offset:
+            tokens.append((TEXT, text[offset : m.start()], None))
+        if kind == "url":
+            tokens.append((URL, m[0], m[0]))
+        else:
+            tokens.append((FORMAT, "", m[0]))
+        offset = m.end()
+    if offset < len(text):
+        tokens.append((TEXT, text[offset:], None))
+    return tokens
+
+
+def _irc_color(code):
+    if code.isdigit() and int(code) < len(_irc_colors):
+        return _irc_colors[int(code)]
+    return None
+
+
+class _Format:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bold = False
+        self.italic = False
+        self.underline = False
+        self.strikethrough = False
+        self.reverse = False
+        self.foreground = None
+        self.background = None
+
+    def apply(self, code):
+        control = code[0]
+        if control == "\x02":
+            self.bold = not self.bold
+        elif control == "\x1d":
+            self.italic = not self.italic
+        elif control == "\x1f":
+            self.underline = not self.underline
+        elif control == "\x1e":
+            self.strikethrough = not self.strikethrough
+        elif control == "\x16":
+            self.reverse = not self.reverse
+        elif control == "\x0f":
+            self.reset()
+        elif len(code) == 1:
+            self.foreground = None
+            self.background = None
+        else:
+            foreground, _, background = code[1:].partition(",")
+            self.foreground = _irc_color(foreground)
+            if background:
+                self.background = _irc_color(background)
+
+    def span(self):
+        attributes = []
+        if self.bold:
+            attributes.append('weight="bold"')
+        if self.italic:
+            attributes.append('style="italic"')
+        if self.underline:
+            attributes.append('underline="single"')
+        if self.strikethrough:
+            attributes.append('strikethrough="true"')
+        foreground = self.foreground
+        background = self.background
+        if self.reverse:
+            foreground, background = background or "#ffffff", foreground or "#000000"
+        if foreground:
+            attributes.append(f'foreground="{foreground}"')
+        if background:
+            attributes.append(f'background="{background}"')
+        if not attributes:
+            return None
+        return "<span " + " ".join(attributes) + ">"
+
+
+def render(tokens):
+    output = []
+    formatting = None
+    in_span = False
+    for kind, text, value in tokens:
+        if kind == TEXT:
+            output.append(escape(text))
+        elif kind == NICK:
+            color = name_to_color(value)
+            output.append('<span color="' + color + '">' + escape(text) + "</span>")
+        elif kind == URL:
+            escaped_url = escape(text)
+            output.append('<a href="' + escaped_url + '">' + escaped_url + "</a>")
+        else:
+            if formatting is None:
+                formatting = _Format()
+            formatting.apply(value)
+            if in_span:
+                output.append("</span>")
+            span = formatting.span()
+            in_span = span is not None
+            if in_span:
+                output.append(span)
+    if in_span:
+        output.append("</span>")
+    return "".join(output)
+
+
+@functools.lru_cache(maxsize=1024)
+def _markup(text):
+    return render(tokenize(text, None))
+
+
+def markup(text, matcher=None):
+    # lines with nicknames are cached by their matcher, which throws them away
+    # once someone joins, leaves or changes their nickname. the least recently
+    # used line goes once the cache is full.
+    if matcher is None:
+        return _markup(text)
+    cache = matcher.markup_cache
+    result = cache.pop(text, None)
+    if result is None:
+        result = render(tokenize(text, matcher))
+        if len(cache) >= matcher.MARKUP_CACHE_SIZE:
+            del cache[next(iter(cache))]
+    cache[text] = result
+    return result
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from .identity import default_casemapping
+
+
+class Membership:
+    # who is in which channel on one server. members[channel] maps every nick
+    # in the channel to its prefixes (e.g. "@+", highest first), and
+    # channels[nick] is the set of channels the nick is in, so a QUIT or a
+    # nick change only has to touch the channels that nick is actually in.
+    # channels and nicks are keyed by their casemapped form.
+    def __init__(self, casemapping=default_casemapping):
+        self.casemapping = casemapping
+        self.members = {}
+        self.channels = {}
+
+    def __contains__(self, channel):
+        return self.casemapping.fold(channel) in self.members
+
+    def reset(self, channel, members):
+        # replaces everyone in a channel, e.g. with the result of NAMES
+        fold = self.casemapping.fold
+        channel = fold(channel)
+        self.leave(channel)
+        self.members[channel] = {
+            fold(nick): prefixes for nick, prefixes in members.items()
+        }
+        for nick in self.members[channel]:
+            self.channels.setdefault(nick, set()).add(channel)
+
+    def leave(self, channel):
+        # we left the channel, so there's nothing to keep track of anymore
+        channel = self.casemapping.fold(channel)
+        for nick in self.members.pop(channel, ()):
+            self._remove_channel(nick, channel)
+
+    def join(self, channel, nick, prefixes=""):
+        channel = self.casemapping.fold(channel)
+        nick = self.casemapping.fold(nick)
+        self.members.setdefault(channel, {})[nick] = prefixes
+        self.channels.setdefault(nick, set()).add(channel)
+
+    def part(self, channel, nick):
+        channel = self.casemapping.fold(channel)
+        nick = self.casemapping.fold(nick)
+        members = self.members.get(channel)
+        if members is None or members.pop(nick, None) is None:
+            return False
+        self._remove_channel(nick, channel)
+        return True
+
+    def quit(self, nick):
+        # returns the (casemapped) channels the nick was in
+        nick = self.casemapping.fold(nick)
+        channels = self.channels.pop(nick, set())
+        for channel in channels:
+            del self.members[channel][nick]
+        return channels
+
+    def rename(self, old_nick, new_nick):
+        # returns the (casemapped) channels the nick is in
+        old_nick = self.casemapping.fold(old_nick)
+        new_nick = self.casemapping.fold(new_nick)
+        channels = self.channels.pop(old_nick, set())
+        if channels:
+            self.channels[new_nick] = channels
+        for channel in channels:
+            members = self.members[channel]
+            members[new_nick] = members.pop(old_nick)
+        return channels
+
+    def set_prefix(self, channel, nick, prefix, added, order):
+        # order is every prefix the server has, highest first. returns the
+        # nick's new prefixes, or None if the nick isn't in the channel.
+        members = self.members.get(self.casemapping.fold(channel))
+        nick = self.casemapping.fold(nick)
+        if members is None or nick not in members:
+            return None
+        prefixes = set(members[nick])
+        if added:
+            prefixes.add(prefix)
+        else:
+            prefixes.discard(prefix)
+        members[nick] = "".join(p for p in order if p in prefixes)
+        return members[nick]
+
+    def _remove_channel(self, nick, channel):
+        channels = self.channels[nick]
+        channels.discard(channel)
+        if not channels:
+            del self.channels[nick]
+
+    def stats(self):
+        return {
+            "channels": len(self.members),
+            "nicks": len(self.channels),
+            "memberships": sum(len(members) for members in self.members.values()),
+        }
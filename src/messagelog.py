@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import datetime
+import re
+import time
+
+from .events import ActionReceived
+from .events import Batch
+from .events import MessageReceived
+from .events import NoticeReceived
+from .events import TopicChanged
+from .events import UserJoined
+from .events import UserKicked
+from .events import UserLeft
+from .events import UserQuit
+from .scrollback import ACTION
+from .scrollback import MESSAGE
+from .scrollback import NOTICE
+
+JOIN = "join"
+PART = "part"
+KICK = "kick"
+QUIT = "quit"
+TOPIC = "topic"
+
+# channel is the casemapped key, server is str(ServerId), time is in seconds
+# since the epoch
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY,
+    server TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    author TEXT,
+    text TEXT,
+    msgid TEXT
+);
+CREATE INDEX IF NOT EXISTS lines_by_channel ON lines (server, channel, time);
+"""
+
+# the full text index only has the text, the rest is looked up in lines. the
+# trigger keeps it up to date as lines are written. all or nothing, SQLite may
+# be built without FTS5.
+FTS_SCHEMA = """
+BEGIN;
+CREATE VIRTUAL TABLE lines_text USING fts5(
+    text, content='lines', content_rowid='id'
+);
+CREATE TRIGGER lines_text_insert AFTER INSERT ON lines
+WHEN new.text IS NOT NULL BEGIN
+    INSERT INTO lines_text (rowid, text) VALUES (new.id, new.text);
+END;
+INSERT INTO lines_text (lines_text) VALUES ('rebuild');
+COMMIT;
+"""
+
+SEARCH_KINDS = (MESSAGE, ACTION, NOTICE)
+
+# text is the words to look for, where "word*" matches anything starting with
+# word. the others narrow the search down, with channel being the casemapped
+# key and after and before in seconds since the epoch.
+SearchQuery = collections.namedtuple(
+    "SearchQuery",
+    ("text", "server", "channel", "author", "after", "before"),
+    defaults=(None, None, None, None, None),
+)
+SearchResult = collections.namedtuple(
+    "SearchResult", ("id", "server", "channel", "time", "kind", "author", "text")
+)
+
+_search_filters = {"in": "channel", "from": "author"}
+_search_dates = {"after", "before"}
+
+
+def parse_search(text):
+    # "in:#channel from:nick after:2021-06-01 before:2021-07-01 some words",
+    # all of them optional. dates are local midnight.
+    words = []
+    fields = {}
+    for word in text.split():
+        name, colon, value = word.partition(":")
+        if colon and value and name in _search_filters:
+            fields[_search_filters[name]] = value
+        elif colon and value and name in _search_dates:
+            try:
+                date = datetime.date.fromisoformat(value)
+            except ValueError as e:
+                raise ValueError(f'"{value}" is not a date like 2021-06-01') from e
+            fields[name] = time.mktime(date.timetuple())
+        else:
+            words.append(word)
+    return SearchQuery(" ".join(words), **fields)
+
+
+def _match_expression(text):
+    # every word has to be in the line. words are quoted, so nothing typed is
+    # taken for FTS5 syntax
+    terms = []
+    for word in re.findall(r"\w+\*?", text):
+        prefix = word.endswith("*")
+        terms.append('"' + word.rstrip("*") + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+# rows that couldn't be written are tried again with the next flush, but only
+# this many of the newest, in case the database never becomes writable again
+MAX_UNWRITTEN = 100000
+
+INSERT = """
+INSERT INTO lines (server, channel, time, kind, author, text, msgid)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def _message_row(kind):
+    def row(event, now):
+        return (
+            str(event.server),
+            event.key,
+            event.time,
+            kind,
+            event.user,
+            event.message,
+            event.msgid,
+        )
+
+    return row
+
+
+def _user_row(kind, text):
+    def row(event, now):
+        return (str(event.server), event.key, now, kind, event.user, text(event), None)
+
+    return row
+
+
+def _topic_row(event, now):
+    return (str(event.server), event.key, now, TOPIC, None, event.topic, None)
+
+
+_rows = {
+    MessageReceived: _message_row(MESSAGE),
+    ActionReceived: _message_row(ACTION),
+    NoticeReceived: _message_row(NOTICE),
+    UserJoined: _user_row(JOIN, lambda event: None),
+    UserLeft: _user_row(PART, lambda event: None),
+    UserKicked: _user_row(KICK, lambda event: f"{event.kicker}: {event.message}"),
+    UserQuit: _user_row(QUIT, lambda event: event.message),
+    TopicChanged: _topic_row,
+}
+
+
+class MessageLog:
+    # keeps everything said in every channel in an SQLite database. events are
+    # only turned into rows as they come in; every flush_interval seconds the
+    # rows so far are handed to a thread that writes them in one transaction,
+    # so the main loop never waits for the disk.
+    def __init__(self, path, clock, flush_interval=1.0):
+        self.path = path
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._connection = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="messagelog"
+        )
+        self._flush_call = None
+        # searches have their own thread and connection, so they don't hold
+        # up writing (and with WAL, writing doesn't hold them up either)
+        self._search_connection = None
+        self._search_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="messagelog-search"
+        )
+        self._unwritten = []
+        self.written = 0
+        self.transactions = 0
+        self.failures = 0
+        self.dropped = 0
+        self.error = None
+        # whether there's a full text index, known once the database is open
+        self.searchable = None
+        self.search_error = None
+
+    def subscribe(self, bus):
+        # returns the subscriptions, to pass to bus.unsubscribe()
+        subscriptions = [
+            bus.subscribe(event_type, self.on_event) for event_type in _rows
+        ]
+        subscriptions.append(bus.subscribe(Batch, self.on_batch))
+        return subscriptions
+
+    def on_event(self, event):
+        self._pending.append(_rows[type(event)](event, self.clock.seconds()))
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.flush_interval, self.flush)
+
+    def on_batch(self, event):
+        # history the server sends is in its own log already
+        if event.type in ("chathistory", "draft/chathistory"):
+            return
+        for batched_event in event.events:
+            if type(batched_event) in _rows:
+                self.on_event(batched_event)
+
+    def flush(self):
+        # returns a future that's done once the rows so far are written
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        rows, self._pending = self._pending, []
+        return self._executor.submit(self._write, rows)
+
+    def search(self, query, before_id=None, limit=50):
+        # returns a future for a list of SearchResults, newest first. for the
+        # next page, pass the id of the last result as before_id.
+        return self._search_executor.submit(self._search, query, before_id, limit)
+
+    def close(self):
+        self.flush()
+        self._executor.submit(self._close)
+        self._executor.shutdown(wait=True)
+        self._search_executor.submit(self._close_search)
+        self._search_executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "unwritten": len(self._unwritten),
+            "written": self.written,
+            "transactions": self.transactions,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "error": self.error,
+        }
+
+    # everything below runs on the log's thread. sqlite3 is only imported
+    # there, the main loop never touches the database.
+
+    def _connect(self):
+        import sqlite3
+
+        if self._connection is None:
+            connection = sqlite3.connect(self.path)
+            try:
+                connection.execute("PRAGMA journal_mode=WAL")
+                # with WAL this can only lose the last transactions on power
+                # loss, never corrupt the database
+                connection.execute("PRAGMA synchronous=NORMAL")
+                connection.executescript(SCHEMA)
+            except sqlite3.Error:
+                # tried again from the start next time
+                connection.close()
+                raise
+            self._connection = connection
+            self.searchable = self._create_index(connection)
+        return self._connection
+
+    def _create_index(self, connection):
+        # lines are logged either way, only searching needs the index
+        import sqlite3
+
+        try:
+            indexed = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'lines_text'"
+            ).fetchone()
+            if not indexed:
+                # also indexes what was logged before there was an index
+                connection.executescript(FTS_SCHEMA)
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.rollback()
+            self.search_error = str(e)
+            return False
+        return True
+
+    def _write(self, rows):
+        import sqlite3
+
+        rows = self._unwritten + rows
+        self._unwritten = []
+        if not rows:
+            return
+        try:
+            connection = self._connect()
+            with connection:
+                connection.executemany(INSERT, rows)
+        except sqlite3.Error as e:
+            # e.g. the disk is full or the database locked, which may pass
+            self.failures += 1
+            self.error = str(e)
+            self._unwritten = rows[-MAX_UNWRITTEN:]
+            self.dropped += len(rows) - len(self._unwritten)
+            return
+        self.error = None
+        self.written += len(rows)
+        self.transactions += 1
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # and this on the search thread
+
+    def _search(self, query, before_id, limit):
+        import sqlite3
+
+        try:
+            if self._search_connection is None:
+                # creates the database and the index if this is the first use
+                self._executor.submit(self._connect).result()
+                self._search_connection = sqlite3.connect(self.path)
+        except sqlite3.Error as e:
+            raise ValueError(f"Could not open the message log: {e}") from e
+        conditions = [f"kind IN ({', '.join('?' * len(SEARCH_KINDS))})"]
+        parameters = list(SEARCH_KINDS)
+        for condition, value in (
+            ("server = ?", query.server),
+            ("channel = ?", query.channel),
+            ("author = ? COLLATE NOCASE", query.author),
+            ("time >= ?", query.after),
+            ("time < ?", query.before),
+            ("lines.id < ?", before_id),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        match = _match_expression(query.text)
+        if match and not self.searchable:
+            raise ValueError(
+                f"The message log can't be searched for words: {self.search_error}"
+            )
+        if match:
+            # newest first straight from the index, which can stop as soon as
+            # it has enough
+            sql = (
+                "SELECT lines.id, server, channel, time, kind, author, lines.text "
+                "FROM lines_text JOIN lines ON lines.id = lines_text.rowid "
+                f"WHERE lines_text MATCH ? AND {' AND '.join(conditions)} "
+                "ORDER BY lines_text.rowid DESC LIMIT ?"
+            )
+            parameters.insert(0, match)
+        else:
+            sql = (
+                "SELECT id, server, channel, time, kind, author, text FROM lines "
+                f"WHERE {' AND '.join(conditions)} ORDER BY id DESC LIMIT ?"
+            )
+        parameters.append(limit)
+        try:
+            rows = self._search_connection.execute(sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            raise ValueError(f"Could not search the message log: {e}") from e
+        return [SearchResult(*row) for row in rows]
+
+    def _close_search(self):
+        if self._search_connection is not None:
+            self._search_connection.close()
+            self._search_connection = None
@@ -1,18 +1,229 @@
 # -*- coding: utf-8 -*-
+import datetime
+import functools
+import sys
+import time
+
+from . import settings
+from .events import ActionReceived
+from .events import Batch
+from .events import ChannelJoined
+from .events import EndNames
+from .events import EventBus
+from .events import MessageReceived
+from .events import NoticeReceived
+from .events import PrefixChanged
+from .events import SignedOn
+from .events import TopicChanged
+from .events import UserJoined
+from .events import UserKicked
+from .events import UserLeft
+from .events import UserQuit
+from .events import UserAway
+from .events import UserRenamed
+from .identity import CaseMapping
+from .identity import default_casemapping
+from .identity import ServerId
+from .membership import Membership
+from .sendqueue import BULK
+from .sendqueue import INTERACTIVE
+from .sendqueue import MAX_LINE_BYTES
+from .sendqueue import PROTOCOL
+from .sendqueue import SendQueue
+from .sendqueue import split_message
+from .sendqueue import URGENT
+
 from . import versions  # noqa nosort
 from twisted.words.protocols import irc  # noqa nosort
 from twisted.internet import reactor  # noqa nosort
 from twisted.internet import protocol  # noqa nosort
 
-
-signals = {}
+bus = EventBus()
 clients = {}
+factories = {}
+# see start()
+message_log = None
+
+# the longest user and host parts of a hostmask, for as long as we don't know
+# our own. see USERLEN and HOSTLEN in RFC 2812 / ircd sources.
+USERLEN = 10
+HOSTLEN = 63
+# channels per JOIN line when rejoining after a reconnect
+JOIN_BATCH_SIZE = 10
+
+# the IRCv3 capabilities we ask for if the server has them
+CAPABILITIES = (
+    "away-notify",
+    "batch",
+    "chathistory",
+    "draft/chathistory",
+    "echo-message",
+    "message-tags",
+    "multi-prefix",
+    "server-time",
+    "userhost-in-names",
+)
+# batch types whose first parameter is the channel (or nickname) they're about
+CHANNEL_BATCHES = ("chathistory", "draft/chathistory")
+
+_no_tags = {}
+_tag_escapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+
+def _unescape_tag(value):
+    if "\\" not in value:
+        return value
+    result = []
+    characters = iter(value)
+    for c in characters:
+        if c == "\\":
+            c = next(characters, "")
+            c = _tag_escapes.get(c, c)
+        result.append(c)
+    return "".join(result)
+
+
+def parse_tags(tags):
+    # "a=1;b;c=x\\sy" -> {"a": "1", "b": "", "c": "x y"}
+    result = {}
+    for tag in tags.split(";"):
+        key, _, value = tag.partition("=")
+        if key:
+            result[key] = _unescape_tag(value)
+    return result
+
+
+def parse_line(line):
+    # "@tags :prefix COMMAND param :trailing param" -> (tags, prefix, command,
+    # params), with as few intermediate strings as possible. lines without
+    # tags share one empty dict, which must not be changed.
+    tags = _no_tags
+    if line[:1] == "@":
+        raw_tags, _, line = line.partition(" ")
+        tags = parse_tags(raw_tags[1:])
+    prefix = ""
+    if line[:1] == ":":
+        prefix, _, line = line.partition(" ")
+        prefix = prefix[1:]
+    line, separator, trailing = line.partition(" :")
+    params = line.split()
+    if not params:
+        raise irc.IRCBadMessage(f"Empty line: {line!r}")
+    if separator:
+        params.append(trailing)
+    return tags, prefix, params.pop(0), params
+
+
+@functools.lru_cache(maxsize=4096)
+def split_prefix(prefix):
+    # "nick!user@host" -> ("nick", "user", "host"). the same few hundred
+    # people send most of the lines, so this is cached.
+    nick, _, userhost = prefix.partition("!")
+    user, _, host = userhost.partition("@")
+    return nick, user, host
+
+
+def nick_of(prefix):
+    return split_prefix(prefix)[0]
+
+
+def format_time(timestamp):
+    timestamp = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def parse_time(value):
+    # server-time timestamps look like 2011-10-19T16:40:51.620Z
+    try:
+        timestamp = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return timestamp.timestamp()
 
 
 class ImprovedBaseIRCClient(irc.IRCClient):
+    def connectionMade(self):
+        # the capabilities the server acknowledged, and the tags of the line
+        # that's being handled
+        self.caps = set()
+        self.tags = _no_tags
+        self.casemapping = default_casemapping
+        self._available_caps = []
+        self._negotiating = False
+        super().connectionMade()
+
+    def register(self, nickname, hostname="foo", servername="bar"):
+        # servers that know CAP hold off on registering us until CAP END
+        self._negotiating = True
+        self.sendLine("CAP LS 302")
+        super().register(nickname, hostname, servername)
+
+    def lineReceived(self, line):
+        # replaces IRCClient.lineReceived, whose parser doesn't know tags
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if "\x10" in line:
+            line = irc.lowDequote(line)
+        try:
+            self.tags, prefix, command, params = parse_line(line)
+        except irc.IRCBadMessage:
+            self.badMessage(line, *sys.exc_info())
+            return
+        try:
+            command = irc.numeric_to_symbolic.get(command, command)
+            self.handleCommand(command, prefix, params)
+        finally:
+            self.tags = _no_tags
+
+    def irc_CAP(self, prefix, params):
+        subcommand = params[1]
+        if subcommand == "LS":
+            # long lists are split over several lines, all but the last one
+            # with a "*" in front of the list
+            self._available_caps.extend(
+                cap.partition("=")[0] for cap in params[-1].split()
+            )
+            if len(params) > 3 and params[2] == "*":
+                return
+            wanted = [cap for cap in CAPABILITIES if cap in self._available_caps]
+            if wanted:
+                self.sendLine("CAP REQ :" + " ".join(wanted))
+            else:
+                self._end_negotiation()
+        elif subcommand == "ACK":
+            for cap in params[-1].split():
+                if cap.startswith("-"):
+                    self.caps.discard(cap[1:])
+                else:
+                    self.caps.add(cap)
+            self._end_negotiation()
+        elif subcommand == "NAK":
+            self._end_negotiation()
+        elif subcommand == "DEL":
+            self.caps.difference_update(params[-1].split())
+
+    def _end_negotiation(self):
+        if self._negotiating:
+            self._negotiating = False
+            self.sendLine("CAP END")
+
+    def message_time(self):
+        # when the line being handled was sent, according to the server if it
+        # supports server-time
+        if "time" in self.tags:
+            timestamp = parse_time(self.tags["time"])
+            if timestamp is not None:
+                return timestamp
+        return time.time()
+
     def names(self, channel):
         self.sendLine(f"NAMES {channel}")
 
+    @property
+    def supports_history(self):
+        # the spec is still a draft, servers may have either name
+        return "chathistory" in self.caps or "draft/chathistory" in self.caps
+
     def listNames(self, channel, names):
         pass
 
@@ -28,6 +239,54 @@ class ImprovedBaseIRCClient(irc.IRCClient):
         channel = params[1]
         self.endNames(channel)
 
+    def irc_RPL_ISUPPORT(self, prefix, params):
+        super().irc_RPL_ISUPPORT(prefix, params)
+        name = self.supported.getFeature("CASEMAPPING", ("rfc1459",))[0]
+        if name != self.casemapping.name:
+            self.casemapping = CaseMapping(name)
+
+    def is_me(self, nick):
+        return self.casemapping.equal(nick, self.nickname)
+
+    def irc_JOIN(self, prefix, params):
+        # our own JOIN is the first time we see the hostmask other clients
+        # will see in front of our messages
+        nick = nick_of(prefix)
+        channel = params[-1]
+        if self.is_me(nick):
+            self.hostmask = prefix
+            self.joined(channel)
+        else:
+            self.userJoined(nick, channel)
+
+    # Twisted compares nicknames case-sensitively, these use the server's
+    # casemapping instead
+
+    def irc_PART(self, prefix, params):
+        nick = nick_of(prefix)
+        channel = params[0]
+        if self.is_me(nick):
+            self.left(channel)
+        else:
+            self.userLeft(nick, channel)
+
+    def irc_KICK(self, prefix, params):
+        kicker = nick_of(prefix)
+        channel = params[0]
+        kicked = params[1]
+        message = params[-1]
+        if self.is_me(kicked):
+            self.kickedFrom(channel, kicker, message)
+        else:
+            self.userKicked(kicked, channel, kicker, message)
+
+    def irc_NICK(self, prefix, params):
+        nick = nick_of(prefix)
+        if self.is_me(nick):
+            self.nickChanged(params[0])
+        else:
+            self.userRenamed(nick, params[0])
+
     def irc_unknown(self, prefix, command, params):
         print(
             "unhandled IRC command:",
@@ -46,180 +305,387 @@ class ImprovedBaseIRCClient(irc.IRCClient):
 
 
 class IRCClient(ImprovedBaseIRCClient):
+    hostmask = None
+
     def __init__(self, factory):
         self.factory = factory
         self.nickname = self.factory.nickname
-        server_id = f"{self.factory.host}:{self.factory.port}"
-        clients[server_id] = self
+        clients[ServerId(self.factory.host, self.factory.port)] = self
+        burst, rate = send_limits(self.factory.host)
+        self.send_queue = SendQueue(self._reallySendLine, reactor, burst, rate)
+
+    def sendLine(self, line, lane=PROTOCOL):
+        self.send_queue.push(line, lane)
+
+    def irc_PING(self, prefix, params):
+        self.sendLine(f"PONG {params[-1]}", URGENT)
+
+    def request_history(self, target, limit, msgid=None, timestamp=None):
+        # asks for up to limit lines before msgid or timestamp, or for the
+        # latest lines if neither is given. they come back in a chathistory
+        # batch.
+        server_limit = self.supported.getFeature("CHATHISTORY", ("",))[0]
+        if server_limit.isdigit() and int(server_limit) > 0:
+            limit = min(limit, int(server_limit))
+        if msgid is not None:
+            command, reference = "BEFORE", f"msgid={msgid}"
+        elif timestamp is not None:
+            command, reference = "BEFORE", f"timestamp={format_time(timestamp)}"
+        else:
+            command, reference = "LATEST", "*"
+        # joining a lot of channels asks for the history of each of them, which
+        # mustn't hold up anything else
+        self.sendLine(f"CHATHISTORY {command} {target} {reference} {limit}", BULK)
+
+    def max_text_bytes(self, command, target):
+        # what's left of a line for the text, once the server has put our
+        # hostmask in front of it for everyone else
+        hostmask = self.hostmask
+        if hostmask is None:
+            hostmask = f"{self.nickname}!{'x' * USERLEN}@{'x' * HOSTLEN}"
+        overhead = f":{hostmask} {command} {target} :".encode("utf-8")
+        return MAX_LINE_BYTES - len(overhead)
+
+    def send_text(self, target, text, action=False):
+        # returns the chunks the text was sent as. text with more than one
+        # line in it is a paste, and goes behind anything typed meanwhile.
+        lane = BULK if "\n" in text.strip() else INTERACTIVE
+        max_bytes = self.max_text_bytes("PRIVMSG", target)
+        if action:
+            max_bytes -= len("\x01ACTION \x01")
+        chunks = split_message(text, max_bytes)
+        for chunk in chunks:
+            if action:
+                chunk = f"\x01ACTION {chunk}\x01"
+            self.sendLine(f"PRIVMSG {target} :{chunk}", lane)
+        return chunks
+
+    def connectionMade(self):
+        super().connectionMade()
+        # batches the server has started and not ended yet, by reference
+        self.batches = {}
+        # the casemapping the network negotiated last time, until it says again
+        self.casemapping = self.factory.casemapping
+        self.membership = Membership(self.casemapping)
+        # NAMES replies that haven't ended yet, by channel
+        self._names = {}
+
+    def irc_RPL_ISUPPORT(self, prefix, params):
+        super().irc_RPL_ISUPPORT(prefix, params)
+        self.membership.casemapping = self.casemapping
+        self.factory.set_casemapping(self.casemapping)
+
+    def publish(self, event):
+        # events from lines that are part of a batch are held back until the
+        # batch ends, and then published together as a single Batch event
+        if event.channel is not None:
+            event.key = self.casemapping.fold(event.channel)
+        batch = self.batches.get(self.tags.get("batch"))
+        if batch is not None:
+            batch.events.append(event)
+        else:
+            bus.publish(event)
+
+    def irc_BATCH(self, prefix, params):
+        reference = params[0]
+        if reference.startswith("+"):
+            batch_type = params[1]
+            batch_params = params[2:]
+            channel = None
+            if batch_type in CHANNEL_BATCHES and batch_params:
+                channel = batch_params[0]
+            self.batches[reference[1:]] = Batch(
+                self.factory.host, self.factory.port, channel, batch_type, batch_params
+            )
+        else:
+            batch = self.batches.pop(reference[1:], None)
+            if batch is not None:
+                # nested batches end up in the events of their parent
+                self.publish(batch)
+
+    def irc_AWAY(self, prefix, params):
+        message = params[0] if params else None
+        self.publish(
+            UserAway(self.factory.host, self.factory.port, nick_of(prefix), message)
+        )
 
     def connectionLost(self, reason):
-        print("connection lost:", reason)
-        server_id = f"{self.factory.host}:{self.factory.port}"
-        if clients[server_id] is self:
+        super().connectionLost(reason)
+        self.batches = {}
+        self.send_queue.clear()
+        server_id = ServerId(self.factory.host, self.factory.port)
+        if clients.get(server_id) is self:
             clients.pop(server_id)
 
     def signedOn(self):
-        self.join("#butter-chat")
-        # self.join("#powder")
+        self.factory.signed_on()
+        self.publish(SignedOn(self.factory.host, self.factory.port))
+        self.join_channels(sorted(self.factory.channels.values()))
+
+    def join_channels(self, channels):
+        # as few JOIN lines as possible, so rejoining a lot of channels after a
+        # reconnect doesn't use up the whole flood control budget
+        batch = []
+        length = len("JOIN ")
+        for channel in channels:
+            size = len(channel.encode("utf-8")) + 1
+            if batch and (
+                len(batch) == JOIN_BATCH_SIZE or length + size > MAX_LINE_BYTES
+            ):
+                self.sendLine("JOIN " + ",".join(batch))
+                batch = []
+                length = len("JOIN ")
+            batch.append(channel)
+            length += size
+        if batch:
+            self.sendLine("JOIN " + ",".join(batch))
+
+    def left(self, channel):
+        self.factory.channels.pop(self.casemapping.fold(channel), None)
+        self.membership.leave(channel)
+
+    def kickedFrom(self, channel, kicker, message):
+        self.factory.channels.pop(self.casemapping.fold(channel), None)
+        self.membership.leave(channel)
 
     def joined(self, channel):
+        self.factory.channels[self.casemapping.fold(channel)] = channel
+        self.membership.reset(channel, {self.nickname: ""})
         host = self.factory.host
         port = self.factory.port
-        _call_handler("channel_joined", channel=channel, host=host, port=port)
-        _call_handler(
-            "user_joined",
-            user=self.nickname,
-            channel=channel,
-            host=self.factory.host,
-            port=self.factory.port,
-        )
+        self.publish(ChannelJoined(host, port, channel))
+        self.publish(UserJoined(host, port, channel, self.nickname))
+        if self.supports_history:
+            self.request_history(channel, settings.HISTORY_JOIN_LINES)
 
     def listNames(self, channel, names):
-        prefixes = self.membership_prefixes
-        filtered_names = [name[1:] if name[0] in prefixes else name for name in names]
-        _call_handler(
-            "list_names",
-            channel=channel,
-            names=filtered_names,
-            host=self.factory.host,
-            port=self.factory.port,
-        )
+        # with multi-prefix there can be more than one prefix in front of a
+        # name, and with userhost-in-names the name is a whole hostmask
+        prefixes = "".join(self.membership_prefixes)
+        members = self._names.setdefault(self.casemapping.fold(channel), {})
+        for name in names:
+            nick = name.lstrip(prefixes)
+            if nick:
+                members[nick_of(nick)] = name[: len(name) - len(nick)]
 
     def endNames(self, channel):
-        _call_handler(
-            "end_names",
-            channel=channel,
-            host=self.factory.host,
-            port=self.factory.port,
+        members = self._names.pop(self.casemapping.fold(channel), {})
+        if self.casemapping.fold(channel) in self.factory.channels:
+            self.membership.reset(channel, members)
+        self.publish(
+            EndNames(self.factory.host, self.factory.port, channel, dict(members))
         )
 
     def privmsg(self, user, channel, message):
-        if channel == self.nickname:
-            channel = user.split("!")[0]
+        if self.is_me(channel):
+            channel = nick_of(user)
         if channel == "*":
             channel = self.factory.host
-        _call_handler(
-            "message_received",
-            user=user.split("!")[0],
-            message=message,
-            channel=channel,
-            host=self.factory.host,
-            port=self.factory.port,
+        self.publish(
+            MessageReceived(
+                self.factory.host,
+                self.factory.port,
+                channel,
+                nick_of(user),
+                message,
+                self.message_time(),
+                self.tags.get("msgid"),
+            )
         )
 
     def action(self, user, channel, message):
-        if channel == self.nickname:
-            channel = user.split("!")[0]
+        if self.is_me(channel):
+            channel = nick_of(user)
         if channel == "*":
             channel = self.factory.host
-        _call_handler(
-            "action_received",
-            user=user.split("!")[0],
-            message=message,
-            channel=channel,
-            host=self.factory.host,
-            port=self.factory.port,
+        self.publish(
+            ActionReceived(
+                self.factory.host,
+                self.factory.port,
+                channel,
+                nick_of(user),
+                message,
+                self.message_time(),
+                self.tags.get("msgid"),
+            )
         )
 
     def noticed(self, user, channel, message):
-        if channel == self.nickname:
-            channel = user.split("!")[0]
+        if self.is_me(channel):
+            channel = nick_of(user)
         if channel == "*":
             channel = self.factory.host
-        _call_handler(
-            "notice_received",
-            user=user.split("!")[0],
-            message=message,
-            channel=channel,
-            host=self.factory.host,
-            port=self.factory.port,
+        self.publish(
+            NoticeReceived(
+                self.factory.host,
+                self.factory.port,
+                channel,
+                nick_of(user),
+                message,
+                self.message_time(),
+                self.tags.get("msgid"),
+            )
         )
 
     def topicUpdated(self, user, channel, newTopic):
-        _call_handler(
-            "topic_changed",
-            topic=newTopic,
-            channel=channel,
-            host=self.factory.host,
-            port=self.factory.port,
+        self.publish(
+            TopicChanged(self.factory.host, self.factory.port, channel, newTopic)
         )
 
     def userJoined(self, user, channel):
-        _call_handler(
-            "user_joined",
-            user=user.split("!")[0],
-            channel=channel,
-            host=self.factory.host,
-            port=self.factory.port,
-        )
+        user = nick_of(user)
+        self.membership.join(channel, user)
+        self.publish(UserJoined(self.factory.host, self.factory.port, channel, user))
 
     def userLeft(self, user, channel):
-        _call_handler(
-            "user_left",
-            user=user.split("!")[0],
-            channel=channel,
-            host=self.factory.host,
-            port=self.factory.port,
+        user = nick_of(user)
+        self.membership.part(channel, user)
+        self.publish(UserLeft(self.factory.host, self.factory.port, channel, user))
+
+    def userKicked(self, kickee, channel, kicker, message):
+        self.membership.part(channel, kickee)
+        self.publish(
+            UserKicked(
+                self.factory.host, self.factory.port, channel, kickee, kicker, message
+            )
         )
 
-    # TODO: userQuit
+    def userQuit(self, user, quitMessage):
+        # QUIT doesn't say which channels, so they come from the membership
+        for channel in self.membership.quit(user):
+            self.publish(
+                UserQuit(
+                    self.factory.host, self.factory.port, channel, user, quitMessage
+                )
+            )
 
     def userRenamed(self, oldname, newname):
-        _call_handler(
-            "user_renamed",
-            old_user=oldname,
-            new_user=newname,
-            host=self.factory.host,
-            port=self.factory.port,
-        )
+        for channel in self.membership.rename(oldname, newname):
+            self.publish(
+                UserRenamed(
+                    self.factory.host, self.factory.port, channel, oldname, newname
+                )
+            )
 
     def nickChanged(self, nick):
-        _call_handler(
-            "user_renamed",
-            old_user=self.nickname,
-            new_user=nick,
-            host=self.factory.host,
-            port=self.factory.port,
-        )
+        self.userRenamed(self.nickname, nick)
+        # the user and host stay the same, and the nick is part of every line
+        # the server relays
+        if self.hostmask is not None:
+            self.hostmask = f"{nick}!{self.hostmask.partition('!')[2]}"
         super().nickChanged(nick)
 
-
-class IRCClientFactory(protocol.ClientFactory):
-    def __init__(self, nickname, host, port):
+    def modeChanged(self, user, channel, set, modes, args):
+        # only the modes that are prefixes (+o is @, +v is +, ...) matter here
+        prefixes = self.supported.getFeature("PREFIX", {})
+        order = "".join(self.membership_prefixes)
+        for mode, arg in zip(modes, args):
+            if mode not in prefixes or arg is None:
+                continue
+            new_prefixes = self.membership.set_prefix(
+                channel, arg, prefixes[mode][0], set, order
+            )
+            if new_prefixes is not None:
+                self.publish(
+                    PrefixChanged(
+                        self.factory.host, self.factory.port, channel, arg, new_prefixes
+                    )
+                )
+
+
+class IRCClientFactory(protocol.ReconnectingClientFactory):
+    # host and port are the network's primary address, and what the network
+    # is known as everywhere else, even while connected to an alternate.
+    def __init__(self, nickname, host, port, alternates=(), channels=()):
         self.nickname = nickname
         self.host = host
         self.port = port
+        self.addresses = [(host, port), *alternates]
+        self.address = 0
+        # channels to join, and to rejoin after reconnecting, by their names
+        # folded with the network's casemapping
+        self.casemapping = default_casemapping
+        self.channels = {self.casemapping.fold(name): name for name in channels}
+        self.initialDelay = self.delay = settings.RECONNECT_INITIAL_DELAY
+        self.maxDelay = settings.RECONNECT_MAX_DELAY
+        self.attempts = 0
+        self.reconnects = 0
+        self.lost_at = None
+        self.time_to_reconnect = None
 
     def buildProtocol(self, addr):
         p = IRCClient(self)
         return p
 
-    def clientConnectionLost(self, connector, reason):
-        # TODO: exponential backoff. there's a specific factory class that does
-        #       that already, so look into that.
-        connector.connect()
-
-    def clientConnectionFailed(self, connector, reason):
-        print("connection failed:", reason)
+    def startedConnecting(self, connector):
+        self.attempts += 1
 
+    def set_casemapping(self, casemapping):
+        if casemapping.name != self.casemapping.name:
+            self.casemapping = casemapping
+            names = self.channels.values()
+            self.channels = {casemapping.fold(name): name for name in names}
 
-def register_handler(signal, f):
-    if signal not in signals:
-        signals[signal] = []
-    signals[signal].append(f)
+    def signed_on(self):
+        self.resetDelay()
+        if self.lost_at is not None:
+            self.reconnects += 1
+            self.time_to_reconnect = reactor.seconds() - self.lost_at
+            self.lost_at = None
 
+    def clientConnectionLost(self, connector, reason):
+        if self.lost_at is None:
+            self.lost_at = reactor.seconds()
+        super().clientConnectionLost(connector, reason)
 
-def _call_handler(signal, **kwargs):
-    for handler in signals.get(signal, []):
-        handler(**kwargs)
+    def clientConnectionFailed(self, connector, reason):
+        print("connection failed:", reason)
+        self.address = (self.address + 1) % len(self.addresses)
+        connector.host, connector.port = self.addresses[self.address]
+        super().clientConnectionFailed(connector, reason)
+
+    def stats(self):
+        return {
+            "address": "{}:{}".format(*self.addresses[self.address]),
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "reconnects": self.reconnects,
+            "delay": self.delay,
+            "time_to_reconnect": self.time_to_reconnect,
+        }
+
+
+def send_limits(host):
+    burst, rate = settings.SEND_LIMITS.get(
+        host, (settings.SEND_BURST, settings.SEND_RATE)
+    )
+    # a rate of 0 would never send anything after the first burst
+    if burst < 1 or rate <= 0:
+        raise ValueError(
+            f"Send limits for {host} need a burst of at least 1 and a rate above 0"
+        )
+    return burst, rate
 
 
-def connect(nickname, host, port=6667):
-    f = IRCClientFactory(nickname, host, port)
+def connect(nickname, host, port=6667, channels=("#butter-chat",)):
+    # bad send limits fail here rather than once connected
+    send_limits(host)
+    alternates = settings.ALTERNATE_SERVERS.get(host, ())
+    f = IRCClientFactory(nickname, host, port, alternates, channels)
+    factories[ServerId(host, port)] = f
     reactor.connectTCP(host, port, f)
 
 
 def start():
+    global message_log
+    if settings.MESSAGE_LOG is not None:
+        from .messagelog import MessageLog
+
+        message_log = MessageLog(
+            settings.MESSAGE_LOG, reactor, settings.MESSAGE_LOG_FLUSH_INTERVAL
+        )
+        message_log.subscribe(bus)
+        reactor.addSystemEventTrigger("before", "shutdown", message_log.close)
     reactor.run()
 
 
@@ -228,35 +694,55 @@ def stop():
 
 
 def send_message(host, port, channel, message):
-    server_id = f"{host}:{port}"
+    server_id = ServerId(host, port)
     client = clients.get(server_id, None)
     if client is None:
         raise ValueError(f"Not connected to {server_id}")
-    client.msg(channel, message)
-    _call_handler(
-        "message_received",
-        user=client.nickname,
-        message=message,
-        channel=channel,
-        host=host,
-        port=port,
-    )
+    chunks = client.send_text(channel, message)
+    # with echo-message the server sends our messages back like anyone else's
+    if "echo-message" not in client.caps:
+        for chunk in chunks:
+            client.publish(
+                MessageReceived(
+                    host, port, channel, client.nickname, chunk, time.time()
+                )
+            )
 
 
 def send_action(host, port, channel, message):
-    server_id = f"{host}:{port}"
+    server_id = ServerId(host, port)
     client = clients.get(server_id, None)
     if client is None:
         raise ValueError(f"Not connected to {server_id}")
-    client.describe(channel, message)
-    _call_handler(
-        "action_received",
-        user=client.nickname,
-        message=message,
-        channel=channel,
-        host=host,
-        port=port,
-    )
+    chunks = client.send_text(channel, message, action=True)
+    if "echo-message" not in client.caps:
+        for chunk in chunks:
+            client.publish(
+                ActionReceived(host, port, channel, client.nickname, chunk, time.time())
+            )
+
+
+def supports_history(host, port):
+    client = clients.get(ServerId(host, port), None)
+    return client is not None and client.supports_history
+
+
+def nickname(host, port):
+    client = clients.get(ServerId(host, port), None)
+    return client.nickname if client is not None else None
+
+
+def casemapping(host, port):
+    factory = factories.get(ServerId(host, port), None)
+    return factory.casemapping if factory is not None else default_casemapping
+
+
+def request_history(host, port, target, limit, msgid=None, timestamp=None):
+    server_id = ServerId(host, port)
+    client = clients.get(server_id, None)
+    if client is None:
+        raise ValueError(f"Not connected to {server_id}")
+    client.request_history(target, limit, msgid, timestamp)
 
 
 def change_nick(nick):
@@ -265,8 +751,36 @@ def change_nick(nick):
 
 
 def join_channel(host, port, channel):
-    server_id = f"{host}:{port}"
+    server_id = ServerId(host, port)
     client = clients.get(server_id, None)
     if client is None:
         raise ValueError(f"Not connected to {server_id}")
     client.join(channel)
+
+
+def snapshot():
+    # the servers to connect to, and the channels to join, on the next start.
+    # see session.py
+    result = []
+    for server_id, factory in factories.items():
+        client = clients.get(server_id, None)
+        result.append(
+            {
+                "host": server_id.host,
+                "port": server_id.port,
+                "nickname": client.nickname if client else factory.nickname,
+                "channels": sorted(factory.channels.values()),
+            }
+        )
+    return result
+
+
+def stats():
+    result = {}
+    for server_id, factory in factories.items():
+        client = clients.get(server_id, None)
+        result[str(server_id)] = {
+            "connection": factory.stats(),
+            "send_queue": client.send_queue.stats() if client else None,
+        }
+    return result
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+import array
+import collections
+import contextlib
+import json
+import sys
+import tempfile
+
+MESSAGE = "message"
+ACTION = "action"
+NOTICE = "notice"
+ERROR = "error"
+
+# time is in seconds since the epoch, msgid is the server's id for the line
+Line = collections.namedtuple(
+    "Line", ("kind", "author", "text", "time", "msgid"), defaults=(None, None)
+)
+
+# the offset of a line that hasn't been written to a Spill yet
+_NOT_SPILLED = 2**64 - 1
+
+_all_scrollbacks = []
+# scrollbacks changed while batched_changes() is active, in the order they changed
+_batch = None
+
+
+def line_key(line):
+    # how the same line is recognised when it comes from more than one place,
+    # e.g. live and again in the server's history
+    if line.msgid is not None:
+        return line.msgid
+    return line.time, line.author, line.text
+
+
+def line_size(line):
+    size = sys.getsizeof(line) + sys.getsizeof(line.text)
+    if line.author is not None:
+        size += sys.getsizeof(line.author)
+    return size
+
+
+class Spill:
+    # evicted lines are appended to an anonymous temporary file, and read back
+    # by absolute index when the user asks for older lines again. history
+    # loaded from the server can be evicted below start, which grows the
+    # offsets at the front until those lines are written too.
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.start = None
+        self._offsets = array.array("Q")
+
+    @property
+    def end(self):
+        if self.start is None:
+            return None
+        return self.start + len(self._offsets)
+
+    def __contains__(self, index):
+        return (
+            self.start is not None
+            and self.start <= index < self.end
+            and self._offsets[index - self.start] != _NOT_SPILLED
+        )
+
+    def write(self, index, line):
+        if index in self:
+            # this line was loaded back from the spill and evicted again
+            return
+        if self.start is None:
+            self.start = index
+        elif index < self.start:
+            gap = array.array("Q", [_NOT_SPILLED]) * (self.start - index)
+            self._offsets[0:0] = gap
+            self.start = index
+        self.file.seek(0, 2)
+        offset = self.file.tell()
+        if index == self.end:
+            self._offsets.append(offset)
+        else:
+            self._offsets[index - self.start] = offset
+        self.file.write(json.dumps(line, ensure_ascii=False).encode("utf-8"))
+        self.file.write(b"\n")
+
+    def read(self, start, end):
+        if self.start is None:
+            return []
+        start = max(start, self.start)
+        end = min(end, self.end)
+        if start >= end:
+            return []
+        lines = []
+        self.file.seek(self._offsets[start - self.start])
+        for offset in self._offsets[start - self.start : end - self.start]:
+            # lines evicted below start were written after the ones above it
+            if offset != self.file.tell():
+                self.file.seek(offset)
+            lines.append(Line(*json.loads(self.file.readline().decode("utf-8"))))
+        return lines
+
+    def close(self):
+        self.file.close()
+
+
+class Scrollback:
+    # lines are addressed by absolute index, starting at self.start, so views
+    # can keep referring to the same line while older lines come and go.
+    def __init__(self, name, max_lines, max_bytes=None, spill=None):
+        self.name = name
+        self._lines = collections.deque()
+        self._listeners = []
+        self.start = 0
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.loader = None
+        self.evicted = 0
+        self.resident_bytes = 0
+        _all_scrollbacks.append(self)
+
+    def __len__(self):
+        return len(self._lines)
+
+    @property
+    def end(self):
+        return self.start + len(self._lines)
+
+    @property
+    def _can_load_from_spill(self):
+        return (
+            self.spill is not None
+            and self.spill.start is not None
+            and self.spill.start < self.start
+        )
+
+    @property
+    def can_load_older(self):
+        return self.loader is not None or self._can_load_from_spill
+
+    def get(self, index):
+        return self._lines[index - self.start]
+
+    def connect(self, callback):
+        self._listeners.append(callback)
+
+    def disconnect(self, callback):
+        self._listeners.remove(callback)
+
+    def close(self):
+        _all_scrollbacks.remove(self)
+        if self.spill is not None:
+            self.spill.close()
+
+    def _changed(self):
+        if _batch is not None:
+            _batch[self] = None
+            return
+        self._notify()
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback(self)
+
+    def _over_limit(self):
+        if len(self._lines) > self.max_lines:
+            return True
+        return (
+            self.max_bytes is not None
+            and self.resident_bytes > self.max_bytes
+            and len(self._lines) > 1
+        )
+
+    def _evict(self):
+        evicted = 0
+        spill = self.spill
+        while self._over_limit():
+            line = self._lines.popleft()
+            self.resident_bytes -= line_size(line)
+            # lines loaded back from the spill were counted the first time
+            if spill is None or self.start not in spill:
+                self.evicted += 1
+            if spill is not None:
+                spill.write(self.start, line)
+            self.start += 1
+            evicted += 1
+        return evicted
+
+    def trim(self):
+        if self._evict():
+            self._changed()
+
+    def append(self, line):
+        self._lines.append(line)
+        self.resident_bytes += line_size(line)
+        self._evict()
+        self._changed()
+
+    def extend(self, lines):
+        self._lines.extend(lines)
+        self.resident_bytes += sum(line_size(line) for line in lines)
+        self._evict()
+        self._changed()
+
+    def prepend(self, lines):
+        # older lines are allowed to go over the limits until the next trim,
+        # otherwise a full scrollback could never show anything older.
+        self._lines.extendleft(reversed(lines))
+        self.resident_bytes += sum(line_size(line) for line in lines)
+        self.start -= len(lines)
+        self._changed()
+
+    def set_loader(self, loader):
+        # loader(scrollback, count) is called for older lines once there are
+        # none left on disk, and is expected to call merge_older() with them
+        # (later). set it to None once there's nothing left to load.
+        self.loader = loader
+        self._changed()
+
+    def load_older(self, count):
+        if self._can_load_from_spill:
+            self.prepend(self.spill.read(self.start - count, self.start))
+        elif self.loader is not None:
+            self.loader(self, count)
+
+    def merge_older(self, lines):
+        # adds lines from somewhere else (e.g. the server's history) before the
+        # first line, skipping the ones that are already here and the ones that
+        # aren't older than the first line.
+        known = {line_key(line) for line in self._lines}
+        first = next((line.time for line in self._lines if line.time is not None), None)
+        lines = [
+            line
+            for line in lines
+            if line_key(line) not in known
+            and (first is None or line.time is None or line.time <= first)
+        ]
+        if lines:
+            self.prepend(lines)
+        return len(lines)
+
+    def merge_newer(self, lines):
+        # adds lines from somewhere else (e.g. what the server's history has
+        # from while we were away) after the last line, skipping the ones that
+        # are already here and the ones that aren't newer than the last line.
+        last = next(
+            (line.time for line in reversed(self._lines) if line.time is not None),
+            None,
+        )
+        if last is None:
+            return 0
+        known = {line_key(line) for line in self._lines}
+        lines = [
+            line
+            for line in lines
+            if line_key(line) not in known
+            and line.time is not None
+            and line.time > last
+        ]
+        if lines:
+            self.extend(lines)
+        return len(lines)
+
+    def add_message(self, author, message, time=None, msgid=None):
+        self.append(Line(MESSAGE, author, message, time, msgid))
+
+    def add_action(self, author, message, time=None, msgid=None):
+        self.append(Line(ACTION, author, message, time, msgid))
+
+    def add_notice(self, author, message, time=None, msgid=None):
+        self.append(Line(NOTICE, author, message, time, msgid))
+
+    def add_error(self, message):
+        self.append(Line(ERROR, None, message))
+
+    def stats(self):
+        return {
+            "lines": len(self._lines),
+            "resident_bytes": self.resident_bytes,
+            "evicted": self.evicted,
+        }
+
+
+@contextlib.contextmanager
+def batched_changes():
+    # listeners only hear about a scrollback once at the end, no matter how
+    # many lines were added to it in the meantime.
+    global _batch
+    if _batch is not None:
+        yield
+        return
+    _batch = {}
+    try:
+        yield
+    finally:
+        changed, _batch = _batch, None
+        for scrollback in changed:
+            scrollback._notify()
+
+
+def stats():
+    return {scrollback.name: scrollback.stats() for scrollback in _all_scrollbacks}
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import collections
+
+# lanes, in the order they're sent in. the urgent lane is for what the server
+# disconnects us over if it's late (PONG), and doesn't wait for a token at
+# all. the protocol lane is for everything
+# else it expects an answer to quickly (JOIN, NICK, ...). bulk is for pastes
+# and anything else that can wait, like CHATHISTORY requests.
+URGENT = 0
+PROTOCOL = 1
+INTERACTIVE = 2
+BULK = 3
+LANES = (URGENT, PROTOCOL, INTERACTIVE, BULK)
+
+# 512 bytes including the CRLF, see RFC 1459 section 2.3
+MAX_LINE_BYTES = 510
+
+
+class SendQueue:
+    # a token bucket: `burst` lines can be sent right away, after that one
+    # more line every 1 / rate seconds. lines wait in their lane until there's
+    # a token for them, so a big paste can't hold up a PONG or what the user
+    # is typing.
+    def __init__(self, send, clock, burst, rate):
+        self.send = send
+        self.clock = clock
+        self.burst = burst
+        self.rate = rate
+        self._tokens = float(burst)
+        self._updated = clock.seconds()
+        self._lanes = tuple(collections.deque() for _ in LANES)
+        self._call = None
+        self._sent_times = collections.deque(maxlen=32)
+        self.sent = 0
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    def push(self, line, lane=PROTOCOL):
+        if lane == URGENT:
+            # still takes its token, which may go below zero, so the lines
+            # after it wait a bit longer instead
+            self._refill()
+            self._tokens -= 1
+            self._send(line)
+            return
+        self._lanes[lane].append(line)
+        if self._call is None:
+            self._drain()
+
+    def clear(self):
+        for lane in self._lanes:
+            lane.clear()
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return now
+
+    def _next_line(self):
+        for lane in self._lanes:
+            if lane:
+                return lane.popleft()
+        return None
+
+    def _drain(self):
+        self._call = None
+        self._refill()
+        while self._tokens >= 1:
+            line = self._next_line()
+            if line is None:
+                return
+            self._tokens -= 1
+            self._send(line)
+        if len(self):
+            delay = (1 - self._tokens) / self.rate
+            self._call = self.clock.callLater(delay, self._drain)
+
+    def _send(self, line):
+        self.sent += 1
+        self._sent_times.append(self.clock.seconds())
+        self.send(line)
+
+    def drain_rate(self):
+        # lines per second over the last few lines that were sent
+        times = self._sent_times
+        if len(times) < 2 or times[-1] == times[0]:
+            return None
+        return (len(times) - 1) / (times[-1] - times[0])
+
+    def stats(self):
+        return {
+            "queued": [len(lane) for lane in self._lanes],
+            "sent": self.sent,
+            "tokens": self._tokens,
+            "burst": self.burst,
+            "rate": self.rate,
+            "drain_rate": self.drain_rate(),
+        }
+
+
+def split_message(text, max_bytes):
+    # splits text into chunks of at most max_bytes of UTF-8, at a space where
+    # possible and never inside a character. every line of the text starts a
+    # new chunk, and empty lines are dropped since they can't be sent.
+    chunks = []
+    for line in text.split("\n"):
+        data = line.rstrip("\r").encode("utf-8")
+        while len(data) > max_bytes:
+            end = max_bytes
+            # continuation bytes are 0b10xxxxxx
+            while end > 0 and data[end] & 0xC0 == 0x80:
+                end -= 1
+            space = data.rfind(b" ", 0, end + 1)
+            if space > max_bytes // 2:
+                end = space
+            chunks.append(data[:end].decode("utf-8"))
+            data = data[end:].lstrip(b" ")
+        if data:
+            chunks.append(data.decode("utf-8"))
+    return chunks
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+# bumped whenever what's in a snapshot changes, older snapshots are ignored
+VERSION = 1
+
+# a snapshot is what the window looked like when the client was closed, so it
+# can look the same right away on the next start, before any server answers:
+#
+# {
+#     "servers": [{"host", "port", "nickname", "channels": [name, ...]}, ...],
+#     "channels": [ChannelModel.snapshot(), ...],
+#     "visible": name of the channel that was shown, in the stack,
+# }
+
+
+def save(path, snapshot):
+    # written next to the old one and moved over it, so a crash while saving
+    # leaves the old snapshot alone
+    temporary = path + ".tmp"
+    # dumps() is the C encoder, dump() would write it bit by bit in Python
+    data = json.dumps({"version": VERSION, **snapshot}, separators=(",", ":"))
+    with open(temporary, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def load(path):
+    # returns None if there's no snapshot that can be used
+    try:
+        with open(path, encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("version") != VERSION:
+        return None
+    return snapshot
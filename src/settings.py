@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# Number of lines kept in memory per channel. Older lines are evicted, and
+# written to a temporary file if SCROLLBACK_SPILL_TO_DISK is set so they can
+# be loaded again.
+SCROLLBACK_MAX_LINES = 5000
+# Optional limit on the (approximate) memory used by a channel's lines.
+SCROLLBACK_MAX_BYTES = None
+SCROLLBACK_SPILL_TO_DISK = False
+# Number of lines loaded at a time by "Load older messages" or by scrolling to
+# the top, from disk or from the server's history.
+SCROLLBACK_LOAD_OLDER_LINES = 200
+
+# Channels that haven't been shown for this many seconds let go of their
+# widgets, they're made again when the channel is shown. None keeps them.
+CHANNEL_VIEW_RELEASE_AFTER = 600
+
+# Number of rendered identicons kept in memory.
+IDENTICON_CACHE_SIZE = 2048
+
+# Number of threads rendering identicons in the background.
+IDENTICON_WORKERS = 2
+
+# Prerendered identicons, see identicon_atlas.py. Optional.
+IDENTICON_ATLAS = "identicon/atlas.bin"
+
+# Flood control for lines sent to the server: SEND_BURST lines can be sent at
+# once, after that SEND_RATE lines per second. SEND_LIMITS overrides both per
+# host, as {"irc.example.com": (burst, rate)}.
+SEND_BURST = 5
+SEND_RATE = 0.5
+SEND_LIMITS = {}
+
+# Reconnecting: the delay starts at RECONNECT_INITIAL_DELAY seconds and grows
+# (with some jitter) up to RECONNECT_MAX_DELAY seconds.
+RECONNECT_INITIAL_DELAY = 1.0
+RECONNECT_MAX_DELAY = 300
+# Other addresses of the same network, tried in order when connecting fails,
+# as {"irc.example.com": [("irc2.example.com", 6667)]}.
+ALTERNATE_SERVERS = {}
+
+# Number of lines requested from servers that keep a history (IRCv3
+# CHATHISTORY) when joining a channel.
+HISTORY_JOIN_LINES = 100
+
+# Everything said in every channel is kept in this SQLite database, None turns
+# that off. Lines are written every MESSAGE_LOG_FLUSH_INTERVAL seconds.
+MESSAGE_LOG = "log.sqlite3"
+MESSAGE_LOG_FLUSH_INTERVAL = 1.0
+
+# What the window looked like is saved here on exit, and shown right away on
+# the next start while the servers are still connecting, with up to
+# SESSION_SNAPSHOT_LINES lines per channel. None turns that off.
+SESSION_SNAPSHOT = "session.json"
+SESSION_SNAPSHOT_LINES = 100